@@ -0,0 +1,557 @@
+"""
+Common reader core for the wad, wad2 and pak archive formats.
+
+All three are the same thing underneath: a 12-byte header pointing at a
+table of fixed-size directory entries, each naming a span of the file.
+Archive takes care of everything that doesn't depend on the format (the
+file handle, positional or mmap'd reads, the name lookup index, turning
+an int/name/entry into an entry) and a subclass only describes its
+header and how to decode its directory table. LumpArchive adds the
+lump API shared by wad and wad2.
+"""
+
+import os
+import mmap
+import bisect
+import asyncio
+import threading
+import collections.abc
+import concurrent.futures
+
+# chunk size used when data has to pass through python
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# worker threads behind the async read methods, unless an archive is
+# given an executor of its own
+ASYNC_WORKERS = 8
+
+_async_executor = None
+_async_executor_lock = threading.Lock()
+
+
+def _defaultExecutor():
+    global _async_executor
+    with _async_executor_lock:
+        if _async_executor is None:
+            _async_executor = concurrent.futures.ThreadPoolExecutor(max_workers=ASYNC_WORKERS, thread_name_prefix="archive")
+        return _async_executor
+
+
+def iterChopBytes(b, chunk_len, count=None, start_offset=0):
+    """
+    Run through a string of bytes, yielding consecutive chunks out of
+    it. A starting byte offset can be given.
+    Note the last chunk could be less than chunk_len if the total length
+    isn't a multiple of chunk_len.
+    """
+
+    if count is not None:
+        idx = start_offset
+        while count > 0:
+            yield b[idx: idx + chunk_len]
+            idx += chunk_len
+            count -= 1
+    else:
+        idx = start_offset
+        while idx < len(b):
+            yield b[idx: idx + chunk_len]
+            idx += chunk_len
+
+
+def cString(raw):
+    """
+    Cut a fixed-size byte field off at its first nul.
+    """
+
+    idx = raw.find(b"\x00")
+    if idx != -1:
+        raw = raw[:idx]
+    return raw
+
+
+def copyFileData(infp, outfp, offset=0, length=None):
+    """
+    Append length bytes of infp starting at offset (by default all of
+    it) to outfp, returning the number of bytes copied. The kernel does
+    the copying where it can (copy_file_range, then sendfile); otherwise
+    the data is streamed through in COPY_CHUNK_SIZE pieces, so memory use
+    never depends on the size of the input.
+    """
+
+    outfp.flush()
+    infd = infp.fileno()
+    outfd = outfp.fileno()
+    if length is None:
+        length = os.fstat(infd).st_size - offset
+    size = length
+    copied = 0
+
+    if hasattr(os, "copy_file_range"):
+        try:
+            while copied < size:
+                n = os.copy_file_range(infd, outfd, size - copied, offset + copied)
+                if n == 0:
+                    break
+                copied += n
+        except OSError:
+            # not supported for this pair of files (or kernel)
+            pass
+
+    if copied < size and hasattr(os, "sendfile"):
+        try:
+            while copied < size:
+                n = os.sendfile(outfd, infd, offset + copied, size - copied)
+                if n == 0:
+                    break
+                copied += n
+        except OSError:
+            pass
+
+    # whatever is left (or everything, if there's no kernel support)
+    infp.seek(offset + copied)
+    while copied < size:
+        buf = infp.read(min(COPY_CHUNK_SIZE, size - copied))
+        if not buf:
+            break
+        outfp.write(buf)
+        copied += len(buf)
+
+    return copied
+
+
+class EntryRef(object):
+    """
+    The data of an entry inside an open archive. Writers accept these
+    as lump/file data and copy the bytes straight across (kernel-side
+    where possible) without decoding or holding them in memory.
+    """
+
+    def __init__(self, archive, offset, length):
+        self.archive = archive
+        self.offset = offset
+        self.length = length
+
+
+def writeData(fp, data):
+    """
+    Write out one lump/file worth of data for the archive writers,
+    returning the number of bytes written. data can be:
+      - bytes or any other buffer (bytearray, memoryview, ...)
+      - a str, taken as the path of a file to copy in
+      - a readable file object, read to its end
+      - an EntryRef into an open archive
+      - a callable returning any of the above, only called when its
+        turn comes so data can be produced lazily
+    Anything coming from a file is streamed, never read in whole.
+    """
+
+    if callable(data):
+        data = data()
+
+    if isinstance(data, EntryRef):
+        return copyFileData(data.archive._handle, fp, data.offset, data.length)
+
+    if isinstance(data, str):
+        with open(data, "rb") as infp:
+            return copyFileData(infp, fp)
+
+    if hasattr(data, "read"):
+        copied = 0
+        while True:
+            buf = data.read(COPY_CHUNK_SIZE)
+            if not buf:
+                break
+            fp.write(buf)
+            copied += len(buf)
+        return copied
+
+    data = memoryview(data)
+    fp.write(data)
+    return data.nbytes
+
+
+class ByteLRUCache(object):
+    """
+    Thread-safe LRU cache of byte strings, bounded by the total number
+    of bytes held rather than the number of items. Counts hits, misses
+    and evictions. Items bigger than the whole budget aren't kept.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        with self._lock:
+            val = self._items.get(key)
+            if val is None:
+                self.misses += 1
+            else:
+                self._items.move_to_end(key)
+                self.hits += 1
+            return val
+
+    def put(self, key, val):
+        if len(val) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._items[key] = val
+            self.size += len(val)
+            while self.size > self.max_bytes:
+                k, v = self._items.popitem(last=False)
+                self.size -= len(v)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+
+class NameMap(collections.abc.Mapping):
+    """
+    Read-only { name: entry } view over an archive's entries, backed by
+    its { name: index } lookup index so no second dict is needed.
+    """
+
+    def __init__(self, entries, name_to_idx):
+        self._entries = entries
+        self._name_to_idx = name_to_idx
+
+    def __getitem__(self, name):
+        return self._entries[self._name_to_idx[name]]
+
+    def __contains__(self, name):
+        return name in self._name_to_idx
+
+    def __iter__(self):
+        return iter(self._name_to_idx)
+
+    def __len__(self):
+        return len(self._name_to_idx)
+
+
+class Archive(object):
+    """
+    Base for the archive readers.
+
+    Subclasses set MAGICS, KIND, ENTRY_CLASS and ENTRY_KIND, and provide
+    _parseHeader and _decodeDirectory. Entries need a filepos attribute;
+    _entrySpan can be overridden if the length isn't called size.
+
+    With mmap=True the whole file is mapped once on open and reads
+    return memoryview slices into the mapping instead of copies. The
+    slices stay valid after close(); the mapping itself is released
+    once the last of them goes away.
+
+    Otherwise reads never touch the shared file position (os.pread
+    where available, a lock around seek+read if not), so one opened
+    archive can be shared by any number of reader threads. Opening or
+    closing while other threads are reading is not safe.
+
+    A non-zero cache_bytes keeps recently read entries in a ByteLRUCache
+    of that many bytes (self.cache), so hot entries such as palettes
+    don't go back to disk. It's emptied whenever the archive is opened
+    or closed, and isn't used in mmap mode, where reads are free anyway.
+
+    The async read methods run the blocking reads on a thread pool
+    (self.executor, or a shared pool of ASYNC_WORKERS threads), so an
+    asyncio event loop never waits on the disk. Concurrent requests for
+    the same entry share a single read.
+    """
+
+    MAGICS = ()
+    KIND = "archive"
+    ENTRY_CLASS = None
+    ENTRY_KIND = "entry"
+
+    def __init__(self, path="", mmap=False, cache_bytes=0):
+        self.cache = ByteLRUCache(cache_bytes) if cache_bytes else None
+        self.executor = None
+
+        self._entries = []
+        self._names = []
+        self._name_to_idx = {}
+        self._name_to_indices = None
+
+        self._handle = None
+        self._map = None
+        self._view = None
+        self._tableofs = 0
+        self._tablelen = 0
+        self._use_mmap = mmap
+        self._lock = threading.Lock()
+        self._inflight = {}
+
+        if path:
+            self.open(path)
+
+    def _parseHeader(self, header):
+        """
+        Given the 12-byte header, return the (offset, length in bytes)
+        of the directory table.
+        """
+
+        raise NotImplementedError("subclasses should implement")
+
+    def _decodeDirectory(self, raw):
+        """
+        Decode the raw directory table, returning
+        (entries, names, name_to_idx): a sequence of ENTRY_CLASS
+        objects, the list of their names, and the { name: index } lookup
+        index (the last of any duplicate names winning).
+        """
+
+        raise NotImplementedError("subclasses should implement")
+
+    def _entrySpan(self, e):
+        return (e.filepos, e.size)
+
+    def open(self, path):
+        handle = open(path, "rb")
+
+        try:
+            header = handle.read(12)
+            if len(header) != 12 or header[:4] not in self.MAGICS:
+                raise Exception("\"{}\" is not a valid {} file".format(path, self.KIND))
+
+            tableofs, tablelen = self._parseHeader(header)
+            handle.seek(tableofs)
+            raw = handle.read(tablelen)
+            entries, names, name_to_idx = self._decodeDirectory(raw)
+        except Exception:
+            handle.close()
+            raise
+
+        self.close()
+        if self.cache is not None:
+            self.cache.clear()
+        self._entries = entries
+        self._names = names
+        self._name_to_idx = name_to_idx
+        self._name_to_indices = None
+        self._handle = handle
+        self._tableofs = tableofs
+        self._tablelen = tablelen
+
+        if self._use_mmap:
+            self._map = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._map)
+
+    def close(self):
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # slices handed out by _readAt are still alive; the
+                # mapping gets unmapped when the last one is collected
+                pass
+            self._map = None
+        if self._handle:
+            self._entries = []
+            self._names = []
+            self._name_to_idx = {}
+            self._name_to_indices = None
+            self._handle.close()
+            self._handle = None
+        if self.cache is not None:
+            self.cache.clear()
+
+    def _entry(self, e):
+        """
+        Get the entry for an index, a name or an entry.
+        """
+
+        if isinstance(e, int):
+            return self._entries[e]
+        elif isinstance(e, str):
+            return self._entries[self._name_to_idx[e]]
+        elif isinstance(e, self.ENTRY_CLASS):
+            return e
+        raise Exception("invalid {} \"{}\"".format(self.ENTRY_KIND, e))
+
+    def _entryIndices(self, name):
+        """
+        Sorted indices of every entry with the given name. The
+        multi-index behind this is built on first use, as the plain
+        lookup index (last one wins) is all most callers need.
+        """
+
+        if self._name_to_indices is None:
+            name_to_indices = {}
+            for idx, n in enumerate(self._names):
+                name_to_indices.setdefault(n, []).append(idx)
+            self._name_to_indices = name_to_indices
+        return self._name_to_indices.get(name, [])
+
+    def _findEntryIndex(self, name, start=0):
+        """
+        Index of the first entry with the given name at or after start,
+        or -1.
+        """
+
+        indices = self._entryIndices(name)
+        i = bisect.bisect_left(indices, start)
+        if i == len(indices):
+            return -1
+        return indices[i]
+
+    def entryRef(self, e):
+        """
+        An EntryRef for an index, a name or an entry, for handing to
+        one of the writers.
+        """
+
+        return EntryRef(self, *self._entrySpan(self._entry(e)))
+
+    def _readEntry(self, e):
+        return self._readSpan(self._entrySpan(self._entry(e)))
+
+    def _readSpan(self, span):
+        if self.cache is None or self._view is not None:
+            return self._readAt(*span)
+
+        dat = self.cache.get(span)
+        if dat is None:
+            dat = self._readAt(*span)
+            self.cache.put(span, dat)
+        return dat
+
+    async def _areadEntry(self, e):
+        """
+        _readEntry for asyncio code: the read runs on the executor, and
+        concurrent requests for the same entry share it.
+        """
+
+        span = self._entrySpan(self._entry(e))
+        if self._view is not None:
+            # mmap'd; nothing to wait for
+            return self._readAt(*span)
+
+        loop = asyncio.get_running_loop()
+        key = (loop, span)
+        fut = self._inflight.get(key)
+        if fut is None:
+            fut = loop.run_in_executor(self.executor or _defaultExecutor(), self._readSpan, span)
+            self._inflight[key] = fut
+            fut.add_done_callback(lambda f: self._inflight.pop(key, None))
+
+        # one waiter being cancelled mustn't cancel the shared read
+        return await asyncio.shield(fut)
+
+    async def _aiterEntry(self, e, chunk_size=COPY_CHUNK_SIZE):
+        """
+        Async iterator over the data of an entry in chunk_size pieces,
+        for streaming big entries out without holding them in memory.
+        """
+
+        offset, length = self._entrySpan(self._entry(e))
+        loop = asyncio.get_running_loop()
+        executor = self.executor or _defaultExecutor()
+
+        end = offset + length
+        while offset < end:
+            count = min(chunk_size, end - offset)
+            if self._view is not None:
+                dat = self._readAt(offset, count)
+            else:
+                dat = await loop.run_in_executor(executor, self._readAt, offset, count)
+            if not dat:
+                break
+            yield dat
+            offset += len(dat)
+
+    def _readAt(self, offset, count):
+        if self._view is not None:
+            return self._view[offset:offset + count]
+
+        if not hasattr(os, "pread"):
+            with self._lock:
+                self._handle.seek(offset)
+                return self._handle.read(count)
+
+        fd = self._handle.fileno()
+        dat = os.pread(fd, count, offset)
+        if len(dat) == count or not dat:
+            return dat
+
+        # short read; keep going until the entry is complete or EOF
+        chunks = [dat]
+        got = len(dat)
+        while got < count:
+            dat = os.pread(fd, count - got, offset + got)
+            if not dat:
+                break
+            chunks.append(dat)
+            got += len(dat)
+        return b"".join(chunks)
+
+    def _fileSize(self):
+        return os.fstat(self._handle.fileno()).st_size
+
+
+class LumpArchive(Archive):
+    """
+    Base for the wad style archives (wad and wad2), whose entries are
+    lumps: the lump lookup and read methods they share.
+    """
+
+    ENTRY_KIND = "lump"
+
+    @property
+    def lumps(self):
+        return self._entries
+
+    @property
+    def lump_name_to_num(self):
+        return self._name_to_idx
+
+    @property
+    def lump_names(self):
+        return self._names
+
+    def lumpNums(self, lumpname):
+        """
+        Indices of all the lumps with the given name, in wad order.
+        (lump_name_to_num only has the last one.)
+        """
+
+        return list(self._entryIndices(lumpname))
+
+    def findLumpNum(self, lumpname, offs=0):
+        """
+        Index of the first lump with the given name at or after offs,
+        or -1 if there isn't one.
+        """
+
+        return self._findEntryIndex(lumpname, offs)
+
+    def readLumpFromOffset(self, lumpname, offs):
+        idx = self.findLumpNum(lumpname, offs)
+        if idx == -1:
+            raise Exception("unable to find lump \"{}\"".format(lumpname))
+        return self.readLump(idx)
+
+    def readLump(self, l):
+        return self._readEntry(l)
+
+    async def areadLump(self, l):
+        return await self._areadEntry(l)
+
+    def aiterLump(self, l, chunk_size=COPY_CHUNK_SIZE):
+        return self._aiterEntry(l, chunk_size)
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+
+"""
+Pack lots of small 8-bit paletted images (wad2 textures, lbm and pcx
+images) into a few big atlas pages, written out as palettized png files
+plus a json manifest of where each image ended up.
+
+Images are placed with the skyline bottom-left method: each page keeps
+its skyline as a list of horizontal segments and a new rectangle goes
+wherever its bottom edge ends up lowest. Images are placed tallest
+first, which keeps the skyline flat and short.
+"""
+
+import os
+import json
+
+import png
+
+
+class _Skyline(object):
+    """
+    The skyline of one page, as parallel lists of segment x, y and
+    width, left to right.
+    """
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.xs = [0]
+        self.ys = [0]
+        self.ws = [width]
+
+        # the widest gap a rectangle of height run_h could go into; the
+        # skyline only ever rises, so it stays an upper bound. Pages
+        # are tried for every rectangle, and this rejects the full ones
+        # without walking their skylines.
+        self.run_h = None
+        self.run = 0
+
+    def _widestRun(self, h):
+        top = self.height - h
+        run = 0
+        ret = 0
+        for y, w in zip(self.ys, self.ws):
+            if y <= top:
+                run += w
+                if run > ret:
+                    ret = run
+            else:
+                run = 0
+        return ret
+
+    def find(self, w, h):
+        """
+        Find the best spot for a w x h rectangle. Returns
+        (segment_index, y), or None if it doesn't fit.
+        """
+
+        if h != self.run_h:
+            self.run_h = h
+            self.run = self._widestRun(h)
+        if w > self.run:
+            return None
+
+        xs = self.xs
+        ys = self.ys
+        ws = self.ws
+        limit = self.width - w
+        best = None
+        best_bottom = self.height - h + 1
+        best_w = 0
+
+        for i in range(len(xs)):
+            if xs[i] > limit:
+                break
+
+            # the rectangle rests on the highest segment under it
+            y = ys[i]
+            left = w - ws[i]
+            j = i + 1
+            while left > 0:
+                if ys[j] > y:
+                    y = ys[j]
+                left -= ws[j]
+                j += 1
+
+            if y < best_bottom or (y == best_bottom and ws[i] < best_w):
+                best = i
+                best_bottom = y
+                best_w = ws[i]
+
+        if best is None:
+            self.run = w - 1
+            return None
+        return (best, best_bottom)
+
+    def place(self, i, y, w, h):
+        """
+        Raise the skyline for a rectangle put at segment i (as returned
+        by find). Returns its x.
+        """
+
+        xs = self.xs
+        ys = self.ys
+        ws = self.ws
+        x = xs[i]
+        end = x + w
+
+        # drop the segments now covered, trim one partly covered
+        j = i
+        while j < len(xs) and xs[j] + ws[j] <= end:
+            j += 1
+        if j < len(xs) and xs[j] < end:
+            ws[j] -= end - xs[j]
+            xs[j] = end
+
+        xs[i:j] = [x]
+        ys[i:j] = [y + h]
+        ws[i:j] = [w]
+
+        # merge with neighbours at the same height
+        if i + 1 < len(xs) and ys[i + 1] == ys[i]:
+            ws[i] += ws[i + 1]
+            del xs[i + 1], ys[i + 1], ws[i + 1]
+        if i > 0 and ys[i - 1] == ys[i]:
+            ws[i - 1] += ws[i]
+            del xs[i], ys[i], ws[i]
+
+        return x
+
+
+def packRects(sizes, page_width=2048, page_height=2048, padding=0):
+    """
+    Pack (width, height) rectangles onto as many page_width x
+    page_height pages as needed. Returns a (page, x, y) for each
+    rectangle, in the same order. padding pixels are left free to the
+    right of and below each rectangle.
+    """
+
+    order = sorted(range(len(sizes)), key=lambda i: (sizes[i][1], sizes[i][0]), reverse=True)
+
+    ret = [None] * len(sizes)
+    pages = []
+    for idx in order:
+        w = sizes[idx][0] + padding
+        h = sizes[idx][1] + padding
+        if sizes[idx][0] > page_width or sizes[idx][1] > page_height:
+            raise ValueError("{}x{} image doesn't fit in a {}x{} page".format(sizes[idx][0], sizes[idx][1], page_width, page_height))
+        # the padding can hang off the page edge
+        w = min(w, page_width)
+        h = min(h, page_height)
+
+        for pagenum, sky in enumerate(pages):
+            spot = sky.find(w, h)
+            if spot is not None:
+                break
+        else:
+            sky = _Skyline(page_width, page_height)
+            pages.append(sky)
+            pagenum = len(pages) - 1
+            spot = sky.find(w, h)
+
+        i, y = spot
+        x = sky.place(i, y, w, h)
+        ret[idx] = (pagenum, x, y)
+
+    return ret
+
+
+class Atlas(object):
+    """
+    Collects images and packs them into pages. Every image is assumed to
+    use the same palette.
+    """
+
+    def __init__(self, page_width=2048, page_height=2048, padding=0):
+        self.page_width = page_width
+        self.page_height = page_height
+        self.padding = padding
+
+        # [(name, width, height, pixels), ...]
+        self.images = []
+        self._name_to_idx = {}
+        # (page, x, y) for each image once packed
+        self.placements = None
+        self.num_pages = 0
+
+    def add(self, name, width, height, pixels):
+        """
+        Add an image; one with the same name as an earlier one replaces
+        it.
+        """
+
+        if len(pixels) != width * height:
+            raise ValueError("pixel count of \"{}\" does not match its dimensions".format(name))
+
+        img = (name, width, height, pixels)
+        idx = self._name_to_idx.get(name)
+        if idx is None:
+            self._name_to_idx[name] = len(self.images)
+            self.images.append(img)
+        else:
+            self.images[idx] = img
+        self.placements = None
+
+    def pack(self):
+        self.placements = packRects([(i[1], i[2]) for i in self.images], self.page_width, self.page_height, self.padding)
+        self.num_pages = max((p[0] for p in self.placements), default=-1) + 1
+
+    def pages(self, fill=0):
+        """
+        Yield the pixels of each page, with the unused space set to the
+        palette index fill.
+        """
+
+        if self.placements is None:
+            self.pack()
+
+        bypage = [[] for _ in range(self.num_pages)]
+        for img, (p, x, y) in zip(self.images, self.placements):
+            bypage[p].append((img, x, y))
+
+        pw = self.page_width
+        for placed in bypage:
+            page = bytearray(bytes((fill,)) * (pw * self.page_height))
+            for (name, w, h, pixels), x, y in placed:
+                ofs = y * pw + x
+                for row in range(h):
+                    page[ofs:ofs + w] = pixels[row * w:(row + 1) * w]
+                    ofs += pw
+            yield bytes(page)
+
+    def manifest(self, page_paths):
+        """
+        A dict, ready to be dumped as json, of where each image is:
+
+        { "pages": [ { "file", "width", "height" }, ... ],
+          "images": { name: { "page", "x", "y", "width", "height",
+                              "uv": [u0, v0, u1, v1] }, ... } }
+        """
+
+        if self.placements is None:
+            self.pack()
+
+        pw = self.page_width
+        ph = self.page_height
+        images = {}
+        for (name, w, h, _), (p, x, y) in zip(self.images, self.placements):
+            images[name] = { "page": p,
+                             "x": x,
+                             "y": y,
+                             "width": w,
+                             "height": h,
+                             "uv": [x / pw, y / ph, (x + w) / pw, (y + h) / ph] }
+
+        pages = [{ "file": path, "width": pw, "height": ph } for path in page_paths]
+        return { "pages": pages, "images": images }
+
+
+def writeAtlas(basepath, atlas, palette, transparent_index=None):
+    """
+    Pack an atlas and write its pages to <basepath>_<N>.png and the
+    manifest to <basepath>.json, with the page file names relative to
+    it. Returns the manifest.
+    """
+
+    fill = 0 if transparent_index is None else transparent_index
+
+    page_paths = []
+    for pagenum, pixels in enumerate(atlas.pages(fill=fill)):
+        path = "{}_{}.png".format(basepath, pagenum)
+        png.writeIndexedPNG(path, pixels, atlas.page_width, atlas.page_height, palette, transparent_index=transparent_index)
+        page_paths.append(os.path.basename(path))
+
+    manifest = atlas.manifest(page_paths)
+    with open(basepath + ".json", "wt") as fp:
+        json.dump(manifest, fp, indent=1)
+    return manifest
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+
+    import wad2
+    import lbm
+    import pcx
+    import q1wadtexgrab
+
+    args = sys.argv[1:]
+    size = 2048
+    padding = 0
+    if "-s" in args:
+        idx = args.index("-s")
+        if args[idx + 1:idx + 2] and args[idx + 1].isdigit() and int(args[idx + 1]) > 0:
+            size = int(args[idx + 1])
+            del args[idx:idx + 2]
+        else:
+            args = []
+    if "-p" in args:
+        idx = args.index("-p")
+        if args[idx + 1:idx + 2] and args[idx + 1].isdigit():
+            padding = int(args[idx + 1])
+            del args[idx:idx + 2]
+        else:
+            args = []
+
+    if len(args) < 2:
+        print("usage: {} [-s page_size] [-p padding] <out_base> <wad2|lbm|pcx> ...".format(sys.argv[0]))
+        print("")
+        print("Pack the textures of wad2 files and lbm/pcx images into\natlas pages, written as <out_base>_N.png, plus a json\nmanifest <out_base>.json. Everything is assumed to use the\npalette of the first input.")
+        sys.exit(0)
+
+    start = time.time()
+    atlas = Atlas(size, size, padding)
+    pal = None
+    for path in args[1:]:
+        with open(path, "rb") as fp:
+            raw = fp.read()
+        base = os.path.splitext(os.path.basename(path))[0]
+
+        if raw[:4] == b"WAD2":
+            w = wad2.Wad2(path)
+            if pal is None and "PALETTE" in w.lump_names:
+                pal = w.readLump("PALETTE")[:768]
+            for l in w.lumps:
+                if l.type == wad2.TYP_MIPTEX:
+                    tname, tw, th, tpix = q1wadtexgrab.parseTex(w.readLump(l))
+                    atlas.add(tname, tw, th, tpix)
+            w.close()
+        elif raw[:4] == b"FORM":
+            pixels, lbmpal, lw, lh = lbm.loadLBM(raw)
+            if pal is None and lbmpal:
+                pal = b"".join(lbmpal)
+            atlas.add(base, lw, lh, pixels)
+        else:
+            pw, ph, pcxpal, pixels = pcx.loadPCXFromRaw(raw)
+            if pal is None:
+                pal = pcxpal
+            atlas.add(base, pw, ph, pixels)
+
+    if pal is None:
+        with open("PALETTE", "rb") as fp:
+            pal = fp.read()[:768]
+
+    writeAtlas(args[0], atlas, pal)
+    print("{} images on {} {}x{} pages in {:.2f}s".format(len(atlas.images), atlas.num_pages, size, size, time.time() - start))
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+"""
+Compare opening a pak with lots of files with the default directory
+(one PackFile per entry) and with Pack(path, compact=True). Each open
+runs in a separate process so the RSS growth is measured on its own
+(linux only: RSS comes from /proc/self/statm).
+"""
+
+import os
+import sys
+import time
+import struct
+import tempfile
+import subprocess
+
+import pak
+
+
+def _mkPak(path, numfiles):
+    with open(path, "wb") as fp:
+        fp.write(b"PACK" + struct.pack("<II", 12, numfiles * pak.PackFile.DISK_SIZE))
+        fp.write(b"".join(struct.pack("<56sII", b"maps/sub%03d/file%06d.bsp" % (i % 1000, i), 0, 0) for i in range(numfiles)))
+
+
+def _rss():
+    with open("/proc/self/statm", "rt") as fp:
+        return int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def _openOnce(path, compact):
+    """
+    Run in the child process; prints the open time and RSS growth.
+    """
+
+    before = _rss()
+    start = time.perf_counter()
+    p = pak.Pack(path, compact=compact)
+    elapsed = time.perf_counter() - start
+    print(elapsed, _rss() - before)
+    p.close()
+
+
+def _measure(path, compact, repeat):
+    best = None
+    rss = None
+    for _ in range(repeat):
+        out = subprocess.check_output([sys.executable, __file__, "--child", path, str(int(compact))])
+        elapsed, grown = out.split()
+        if best is None or float(elapsed) < best:
+            best = float(elapsed)
+        rss = int(grown)
+    return (best, rss)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--child"]:
+        _openOnce(sys.argv[2], bool(int(sys.argv[3])))
+        sys.exit(0)
+
+    numfiles = int(sys.argv[1]) if len(sys.argv) > 1 else 150000
+    repeat = 3
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "bench.pak")
+        _mkPak(path, numfiles)
+
+        for label, compact in (("default", False), ("compact=True", True)):
+            elapsed, rss = _measure(path, compact, repeat)
+            print("{}: {} files, {:.1f}ms open, +{:.1f} MB RSS".format(label, numfiles, elapsed * 1000, rss / (1024 * 1024)))
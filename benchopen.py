@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+"""
+Time opening wad and wad2 files with lots of lumps. Wad/Wad2 decode the
+whole directory in a single struct pass; for comparison the same
+directory is also decoded one entry at a time with
+WadLump.newFromBytes, the way they used to.
+"""
+
+import os
+import sys
+import time
+import struct
+import tempfile
+
+import wad
+import wad2
+
+
+def _mkWad(path, numlumps):
+    names = [b"MAP%02d" % (i % 100) for i in range(numlumps // 11)]
+    entries = []
+    for mapname in names:
+        entries.append(mapname)
+        entries.extend(n.encode() for n in wad.MAP_LUMPS[:10])
+    entries.extend(b"LUMP%04d" % i for i in range(numlumps - len(entries)))
+
+    with open(path, "wb") as fp:
+        fp.write(b"PWAD" + struct.pack("<ii", len(entries), 12))
+        fp.write(b"".join(struct.pack("<ii8s", 12, 0, n) for n in entries))
+
+
+def _mkWad2(path, numlumps):
+    with open(path, "wb") as fp:
+        fp.write(b"WAD2" + struct.pack("<ii", numlumps, 12))
+        fp.write(b"".join(struct.pack("<iiiBBBB16s", 12, 0, 0, wad2.TYP_MIPTEX, 0, 0, 0, b"TEX%05d" % i) for i in range(numlumps)))
+
+
+def _openPerEntry(module, path):
+    with open(path, "rb") as fp:
+        numlumps, infotableofs = struct.unpack("<ii", fp.read(12)[4:])
+        fp.seek(infotableofs)
+        raw = fp.read(numlumps * module.WadLump.DISK_SIZE)
+
+    lumps = [module.WadLump.newFromBytes(raw, idx * module.WadLump.DISK_SIZE) for idx in range(numlumps)]
+    lump_name_to_num = { l.name: idx for idx, l in enumerate(lumps) }
+    lump_names = [l.name for l in lumps]
+    return (lumps, lump_name_to_num, lump_names)
+
+
+def _best(fn, repeat):
+    ret = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        if ret is None or elapsed < ret:
+            ret = elapsed
+    return ret
+
+
+if __name__ == "__main__":
+    numlumps = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    repeat = 7
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for module, cls, mk in ((wad, wad.Wad, _mkWad), (wad2, wad2.Wad2, _mkWad2)):
+            path = os.path.join(tmpdir, "bench.{}".format(module.__name__))
+            mk(path, numlumps)
+
+            old = _best(lambda: _openPerEntry(module, path), repeat)
+            new = _best(lambda: cls(path).close(), repeat)
+
+            print("{}: {} lumps, per-entry {:.1f}ms, bulk {:.1f}ms ({:.1f}x)".format(module.__name__, numlumps, old * 1000, new * 1000, old / new))
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+"""
+Read the embedded textures out of quake (version 29) .bsp files.
+
+Everything works on the raw bsp data, and slices of it are returned as
+memoryviews so nothing gets copied; handing in the memoryview from an
+mmap'd pak.Pack.readFile reads straight out of the pak.
+"""
+
+import struct
+
+BSPVERSION = 29
+
+HEADER_LUMPS = 15
+
+LUMP_ENTITIES = 0
+LUMP_PLANES = 1
+LUMP_TEXTURES = 2
+LUMP_VERTEXES = 3
+LUMP_VISIBILITY = 4
+LUMP_NODES = 5
+LUMP_TEXINFO = 6
+LUMP_FACES = 7
+LUMP_LIGHTING = 8
+LUMP_CLIPNODES = 9
+LUMP_LEAFS = 10
+LUMP_MARKSURFACES = 11
+LUMP_EDGES = 12
+LUMP_SURFEDGES = 13
+LUMP_MODELS = 14
+
+_header_struct = struct.Struct("<i{}i".format(HEADER_LUMPS * 2))
+
+
+def readLumpDir(raw):
+    """
+    Returns the (offset, length) of each lump of a bsp.
+    """
+
+    if len(raw) < _header_struct.size:
+        raise ValueError("bsp too short")
+    vals = _header_struct.unpack_from(raw)
+    if vals[0] != BSPVERSION:
+        raise ValueError("unsupported bsp version {}".format(vals[0]))
+
+    ret = list(zip(vals[1::2], vals[2::2]))
+    for ofs, length in ret:
+        if ofs < 0 or length < 0 or ofs + length > len(raw):
+            raise ValueError("bsp lump runs past end of file")
+    return ret
+
+
+def readLump(raw, lumpnum):
+    ofs, length = readLumpDir(raw)[lumpnum]
+    return memoryview(raw)[ofs:ofs + length]
+
+
+def textureLumps(raw):
+    """
+    Split the texture lump of a bsp into the data of each miptex, in
+    the same form as a wad2 miptex lump (so it can go to
+    q1wadtexgrab.parseTex). Entries the bsp leaves empty are None.
+    """
+
+    lump = readLump(raw, LUMP_TEXTURES)
+    if not len(lump):
+        return []
+
+    count, = struct.unpack_from("<i", lump)
+    offsets = struct.unpack_from("<{}i".format(count), lump, 4)
+    offsets = [o if 0 <= o < len(lump) else None for o in offsets]
+
+    # a miptex runs up to the next one (or the end of the lump)
+    ends = sorted(set(o for o in offsets if o is not None)) + [len(lump)]
+    nextofs = { ends[i]: ends[i + 1] for i in range(len(ends) - 1) }
+
+    return [lump[o:nextofs[o]] if o is not None else None for o in offsets]
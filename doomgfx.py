@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+
+"""
+Decode DOOM engine pictures (patches, sprites, etc.) and build the wall
+textures described by TEXTURE1/TEXTURE2 and PNAMES.
+"""
+
+import struct
+import collections
+
+import wad
+import palette
+
+
+class Picture(object):
+    """
+    An 8-bit paletted image. Doom draws pictures a column at a time, so
+    pixels are kept column-major: column x is
+    colpixels[x * height:(x + 1) * height]. colmask holds 1 for each
+    pixel that's drawn, 0 for holes.
+
+    For pictures decoded from a patch, posts[x] lists the (top, length)
+    runs of drawn pixels in column x.
+    """
+
+    def __init__(self, width, height, leftoffset=0, topoffset=0):
+        self.width = width
+        self.height = height
+        self.leftoffset = leftoffset
+        self.topoffset = topoffset
+        self.colpixels = bytearray(width * height)
+        self.colmask = bytearray(width * height)
+        self.posts = None
+
+    def drawPicture(self, pic, x, y):
+        """
+        Draw a (patch) picture onto this one with its top-left corner
+        at x, y. Only the posts of the picture are copied, clipped to
+        this picture's bounds.
+        """
+
+        h = self.height
+        for px in range(max(0, -x), min(pic.width, self.width - x)):
+            src = px * pic.height
+            dst = (x + px) * h
+            for top, length in pic.posts[px]:
+                start = max(top + y, 0)
+                end = min(top + y + length, h)
+                if start >= end:
+                    continue
+                sofs = src + start - y
+                self.colpixels[dst + start:dst + end] = pic.colpixels[sofs:sofs + end - start]
+                self.colmask[dst + start:dst + end] = b"\x01" * (end - start)
+
+    def pixels(self):
+        """
+        Palette indices in row-major order.
+        """
+
+        return b"".join(self.colpixels[y::self.height] for y in range(self.height))
+
+    def mask(self):
+        """
+        Row-major drawn (1) / hole (0) flags.
+        """
+
+        return b"".join(self.colmask[y::self.height] for y in range(self.height))
+
+    def toRGBA(self, pal):
+        """
+        Expand to RGBA bytes using a 768-byte palette (eg. the first
+        PLAYPAL), holes becoming fully transparent. The result can go
+        straight to png.buildPNG(..., is_rgba=True).
+        """
+
+        return palette.expandToRGBA(self.pixels(), pal, mask=self.mask())
+
+
+def decodePatch(raw):
+    """
+    Decode a picture in the doom patch format: a header, one offset per
+    column, and each column as a run of posts. Tall patches (posts more
+    than 254 pixels down, using relative topdeltas) are handled.
+    """
+
+    width, height, leftoffset, topoffset = struct.unpack("<hhhh", raw[:8])
+    if width <= 0 or height <= 0 or 8 + width * 4 > len(raw):
+        raise ValueError("invalid patch header")
+
+    pic = Picture(width, height, leftoffset, topoffset)
+    pic.posts = []
+    columnofs = struct.unpack("<{}i".format(width), raw[8:8 + width * 4])
+
+    for x, ofs in enumerate(columnofs):
+        posts = []
+        colbase = x * height
+        top = -1
+        while ofs < len(raw) and raw[ofs] != 0xff:
+            topdelta = raw[ofs]
+            length = raw[ofs + 1]
+            if topdelta <= top:
+                top += topdelta
+            else:
+                top = topdelta
+            # skip the unused byte before and after the post's pixels
+            dat = raw[ofs + 3:ofs + 3 + length]
+            ofs += length + 4
+
+            end = min(top + len(dat), height)
+            if end > top:
+                pic.colpixels[colbase + top:colbase + end] = dat[:end - top]
+                pic.colmask[colbase + top:colbase + end] = b"\x01" * (end - top)
+                posts.append((top, end - top))
+        pic.posts.append(posts)
+
+    return pic
+
+
+class TexturePatch(object):
+    def __init__(self, originx, originy, patchname):
+        self.originx = originx
+        self.originy = originy
+        self.patchname = patchname
+
+
+class TextureDef(object):
+    """
+    One composite texture from a TEXTURE1/TEXTURE2 lump.
+    """
+
+    def __init__(self, name, width, height, masked, patches):
+        self.name = name
+        self.width = width
+        self.height = height
+        self.masked = masked
+        self.patches = patches
+
+
+def parsePNames(raw):
+    count, = struct.unpack("<i", raw[:4])
+    return [wad.wadBytesToString(n) for n in wad.iterChopBytes(raw, 8, count, 4)]
+
+
+def parseTextures(raw, pnames):
+    """
+    Parse a TEXTURE1/TEXTURE2 lump into TextureDefs, with patch numbers
+    already turned into names using the PNAMES list.
+    """
+
+    count, = struct.unpack("<i", raw[:4])
+    offsets = struct.unpack("<{}i".format(count), raw[4:4 + count * 4])
+
+    ret = []
+    for ofs in offsets:
+        name, masked, width, height, _, patchcount = struct.unpack("<8sihhih", raw[ofs:ofs + 22])
+        patches = []
+        for pofs in range(ofs + 22, ofs + 22 + patchcount * 10, 10):
+            originx, originy, patchnum = struct.unpack("<hhh", raw[pofs:pofs + 6])
+            patches.append(TexturePatch(originx, originy, pnames[patchnum]))
+        ret.append(TextureDef(wad.wadBytesToString(name), width, height, bool(masked), patches))
+    return ret
+
+
+class TextureBuilder(object):
+    """
+    Builds the composite wall textures of a wad. Lots of textures share
+    the same patches, so decoded patches are kept in an LRU cache
+    holding up to cache_size of them; hits and misses are counted.
+    """
+
+    def __init__(self, w, cache_size=256):
+        self.wad = w
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+
+        self._cache = collections.OrderedDict()
+        self._textures = collections.OrderedDict()
+
+        pnames = parsePNames(w.readLump("PNAMES"))
+        for lumpname in ("TEXTURE1", "TEXTURE2"):
+            if lumpname in w.lump_name_to_num:
+                for t in parseTextures(w.readLump(lumpname), pnames):
+                    self._textures[t.name] = t
+
+    def textureNames(self):
+        return list(self._textures.keys())
+
+    def textureDef(self, name):
+        return self._textures[name.upper()]
+
+    def patch(self, name):
+        """
+        Get a decoded patch, through the cache.
+        """
+
+        pic = self._cache.get(name)
+        if pic is not None:
+            self._cache.move_to_end(name)
+            self.hits += 1
+            return pic
+
+        self.misses += 1
+        lump = self.wad.namespace("P").get(name)
+        if lump is None:
+            lump = name
+        pic = decodePatch(self.wad.readLump(lump))
+
+        self._cache[name] = pic
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return pic
+
+    def buildTexture(self, name):
+        """
+        Composite a texture out of its patches.
+        """
+
+        t = self.textureDef(name)
+        pic = Picture(t.width, t.height)
+        for p in t.patches:
+            pic.drawPicture(self.patch(p.patchname), p.originx, p.originy)
+        return pic
+
+
+if __name__ == "__main__":
+    import sys
+
+    import png
+
+    if len(sys.argv) < 2:
+        print("usage: {} <wad> [texture ...]".format(sys.argv[0]))
+        print("")
+        print("Write out composite wall textures as png files (all of\nthem if none are named).")
+        sys.exit(0)
+
+    # mmap'd, so lumps are read as memoryviews straight out of the file
+    w = wad.Wad(sys.argv[1], mmap=True)
+    pal = w.readLump("PLAYPAL")[:768]
+    builder = TextureBuilder(w)
+
+    for name in sys.argv[2:] or builder.textureNames():
+        pic = builder.buildTexture(name)
+        outpath = "{}.png".format(name)
+        png.writePNG(outpath, pic.toRGBA(pal), pic.width, pic.height, is_rgba=True)
+        print("wrote \"{}\"".format(outpath))
+
+    print("{} patch cache hits, {} misses".format(builder.hits, builder.misses))
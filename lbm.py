@@ -94,9 +94,7 @@ if __name__ == "__main__":
         if not pal:
             raise ValueError("file contains no colormap")
 
-        rgb = b"".join((pal[p] for p in pixels))
-
         base, ext = os.path.splitext(path)
         outpath = os.path.extsep.join((base, "png"))
-        png.writePNG(outpath, rgb, w, h)
+        png.writeIndexedPNG(outpath, pixels, w, h, pal)
 
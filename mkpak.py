@@ -2,7 +2,13 @@
 
 import sys
 import os
+import time
 import struct
+import hashlib
+import collections
+
+import pak
+from archive import COPY_CHUNK_SIZE, copyFileData
 
 
 class PakEntry(object):
@@ -13,51 +19,235 @@ class PakEntry(object):
         self.filepos = pos
         self.filelen = length
 
-    def rawInfo(self):
-        return struct.pack("56s", self.name.encode()) + \
-               struct.pack("<I", self.filepos) + \
-               struct.pack("<I", self.filelen)
+    @staticmethod
+    def rawDirectory(entries):
+        """
+        Pack a whole directory table in one go.
+        """
+
+        fields = []
+        for e in entries:
+            fields.extend((e.name.encode(), e.filepos, e.filelen))
+        return struct.pack("<" + "56sII" * len(entries), *fields)
+
+
+def _hashFileData(fp, offset=0, length=None):
+    h = hashlib.sha256()
+    fp.seek(offset)
+    while length is None or length > 0:
+        if length is None:
+            buf = fp.read(COPY_CHUNK_SIZE)
+        else:
+            buf = fp.read(min(COPY_CHUNK_SIZE, length))
+            length -= len(buf)
+        if not buf:
+            break
+        h.update(buf)
+    return h.digest()
+
+
+def _writeDirectory(fp, entries, dirofs):
+    """
+    Write the directory at dirofs, then point the header at it.
+    """
 
+    dirraw = PakEntry.rawDirectory(entries)
+    fp.seek(dirofs)
+    fp.write(dirraw)
+    fp.truncate()
 
-def packFiles(path, filenames):
+    fp.seek(0)
+    fp.write(b"PACK")
+    fp.write(struct.pack("<I", dirofs))
+    fp.write(struct.pack("<I", len(dirraw)))
+
+
+def packFiles(path, filenames, dedupe=False):
+    """
+    Write the given files out to a new pak.
+
+    With dedupe, inputs that are byte-for-byte copies of an earlier one
+    aren't written again; their entry points at the earlier copy. Only
+    inputs the same size as another input get hashed (before copying),
+    the rest are copied straight away.
+
+    The pak's mtime is set to when packing started; see updatePak.
+    """
+
+    start_ns = time.time_ns()
     entries = []
+    digest_to_data = {}
+    shared = 0
+
+    if dedupe:
+        size_count = collections.Counter(os.path.getsize(fn) for fn in filenames)
 
     with open(path, "wb") as fp:
         fp.write(b"\x00" * 12) # header will get overwritten later with correct info
 
         for fn in filenames:
             name = "/".join(fn.split(os.path.sep))
+            filepos = fp.tell()
             with open(fn, "rb") as infp:
-                dat = infp.read()
-            entries.append(PakEntry(name, fp.tell(), len(dat)))
-            fp.write(dat)
+                digest = None
+                if dedupe and size_count[os.fstat(infp.fileno()).st_size] > 1:
+                    digest = _hashFileData(infp)
+                    infp.seek(0)
+
+                if digest in digest_to_data:
+                    filepos, filelen = digest_to_data[digest]
+                    shared += 1
+                else:
+                    filelen = copyFileData(infp, fp)
+                    if digest is not None:
+                        digest_to_data[digest] = (filepos, filelen)
+
+            entries.append(PakEntry(name, filepos, filelen))
             print("added \"{}\"".format(name))
 
-        dirofs = fp.tell()
+        _writeDirectory(fp, entries, fp.tell())
+
+    os.utime(path, ns=(time.time_ns(), start_ns))
+
+    if dedupe:
+        print("wrote {} files ({} sharing data with another)".format(len(entries), shared))
+    else:
+        print("wrote {} files".format(len(entries)))
+
+
+def updatePak(path, filenames, use_hash=False):
+    """
+    Bring an existing pak up to date with the given files without
+    rewriting it. Files whose entry is unchanged are skipped; anything
+    new or changed is appended after the current end of the pak, and
+    only the directory and header are rewritten. Entries for files not
+    in the list are kept as-is.
+
+    An input counts as unchanged when its size matches the entry and it
+    was last modified before the pak was. With use_hash the contents of
+    same-sized inputs are compared by hash instead of trusting mtimes.
+    Once updated, the pak's mtime is set to when the update started, so
+    an input changed while it ran isn't mistaken for unchanged later.
+
+    Replaced data is left behind as dead space; see compactPak.
+    """
+
+    p = pak.Pack(path)
+    entries = [PakEntry(f.name, f.filepos, f.filelen) for f in p.files]
+    p.close()
+
+    name_to_entry = { e.name: e for e in entries }
+    pak_mtime = os.stat(path).st_mtime_ns
+    start_ns = time.time_ns()
+    added = 0
+    skipped = 0
+
+    with open(path, "r+b") as fp:
+        # new data goes after everything, including the old directory,
+        # so the pak stays valid until the new header is written
+        fp.seek(0, os.SEEK_END)
+
+        for fn in filenames:
+            name = "/".join(fn.split(os.path.sep))
+            e = name_to_entry.get(name)
+            st = os.stat(fn)
+
+            if e is not None and e.filelen == st.st_size:
+                if use_hash:
+                    with open(fn, "rb") as infp:
+                        unchanged = _hashFileData(infp) == _hashFileData(fp, e.filepos, e.filelen)
+                    fp.seek(0, os.SEEK_END)
+                else:
+                    unchanged = st.st_mtime_ns < pak_mtime
+                if unchanged:
+                    skipped += 1
+                    continue
+
+            filepos = fp.tell()
+            with open(fn, "rb") as infp:
+                filelen = copyFileData(infp, fp)
+
+            if e is None:
+                e = PakEntry(name, filepos, filelen)
+                entries.append(e)
+                name_to_entry[name] = e
+            else:
+                e.filepos = filepos
+                e.filelen = filelen
+            added += 1
+            print("added \"{}\"".format(name))
+
+        if added:
+            _writeDirectory(fp, entries, fp.tell())
+
+    if added:
+        os.utime(path, ns=(time.time_ns(), start_ns))
+
+    print("updated {} files, {} unchanged".format(added, skipped))
+
+
+def compactPak(path):
+    """
+    Rewrite a pak without the dead space left behind by updatePak.
+    Entries sharing the same data stay shared.
+    """
+
+    p = pak.Pack(path)
+    entries = [PakEntry(f.name, f.filepos, f.filelen) for f in p.files]
+    p.close()
+
+    tmppath = path + ".tmp"
+    moved = {}
+    st = os.stat(path)
+
+    with open(path, "rb") as infp, open(tmppath, "wb") as fp:
+        fp.write(b"\x00" * 12)
 
         for e in entries:
-            fp.write(e.rawInfo())
+            key = (e.filepos, e.filelen)
+            if key not in moved:
+                moved[key] = fp.tell()
+                copyFileData(infp, fp, e.filepos, e.filelen)
+            e.filepos = moved[key]
 
-        dirlen = fp.tell() - dirofs
+        _writeDirectory(fp, entries, fp.tell())
 
-        fp.seek(0)
-        fp.write(b"PACK")
-        fp.write(struct.pack("<I", dirofs))
-        fp.write(struct.pack("<I", dirlen))
+    # updatePak goes by the pak's mtime; the data is just as old as before
+    os.utime(tmppath, ns=(st.st_atime_ns, st.st_mtime_ns))
 
-        print("wrote {} files".format(len(entries)))
+    before = st.st_size
+    os.replace(tmppath, path)
+    print("compacted {} bytes to {}".format(before, os.path.getsize(path)))
 
 
 def main(argv):
-    if len(sys.argv) != 3:
-        print("usage: {} <output_pak> <file_list>".format(sys.argv[0]))
+    args = argv[1:]
+    update = "-u" in args
+    compact = "-c" in args
+    use_hash = "--hash" in args
+    dedupe = "-d" in args
+    args = [a for a in args if a not in ("-u", "-c", "-d", "--hash")]
+
+    if compact and len(args) == 1:
+        compactPak(args[0])
+        return
+
+    if len(args) != 2:
+        print("usage: {} [-d | -u [--hash]] <output_pak> <file_list>".format(argv[0]))
+        print("       {} -c <pak>".format(argv[0]))
         print("")
         print("Collect files into a single .pak file. The input files are\ngiven as a simple list of files in the input file. If '-' is\ngiven as the file list, read the list from stdin.")
         print("")
+        print("With -u an existing pak is updated in place: only new or\nchanged files are appended. Unchanged files are detected by\nsize and mtime, or by content with --hash. -c rewrites a pak\nwithout the space left over from earlier updates. -d stores\nidentical files only once.")
+        print("")
         sys.exit(0)
 
-    out_path = sys.argv[1]
-    in_path = sys.argv[2]
+    if update and dedupe:
+        print("error: -d can't be used with -u")
+        sys.exit(1)
+
+    out_path = args[0]
+    in_path = args[1]
 
     if in_path == "-":
         lines = [l.strip() for l in sys.stdin.readlines()]
@@ -73,7 +263,13 @@ def main(argv):
             print("error: non-relative path \"{}\"".format(fn))
             sys.exit(0)
 
-    packFiles(out_path, filenames)
+    if update and os.path.exists(out_path):
+        updatePak(out_path, filenames, use_hash=use_hash)
+    else:
+        packFiles(out_path, filenames, dedupe=dedupe)
+
+    if compact:
+        compactPak(out_path)
 
 
 if __name__ == "__main__":
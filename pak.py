@@ -2,8 +2,17 @@
 Utility to load Quake1 or Quake2 data pak files.
 """
 
+import os
+import sys
+import array
 import types
+import fnmatch
 import struct
+import hashlib
+import collections.abc
+import concurrent.futures
+
+import archive
 
 
 def _pythonifyString(s):
@@ -11,9 +20,7 @@ def _pythonifyString(s):
     Get rid of c-style string terminators.
     """
 
-    if b"\x00" in s:
-        s = s[:s.index(b"\x00")]
-    return s.decode()
+    return archive.cString(s).decode()
 
 
 class PackFile(object):
@@ -24,101 +31,594 @@ class PackFile(object):
 
     DISK_SIZE = 64
 
+    def __init__(self, raw=None):
+        if raw is None:
+            self.name = ""
+            self.filepos = 0
+            self.filelen = 0
+        else:
+            self.name = _pythonifyString(raw[:56])
+            self.filepos, = struct.unpack("<I", raw[56:60])
+            self.filelen, = struct.unpack("<I", raw[60:64])
+
+    @classmethod
+    def newFromValues(cls, name, filepos, filelen):
+        ret = cls()
+        ret.name = name
+        ret.filepos = filepos
+        ret.filelen = filelen
+        return ret
+
+
+_packfile_struct = struct.Struct("<56sII")
+
+
+class _CompactDirectory(collections.abc.Sequence):
+    """
+    A pak directory held as parallel arrays (names, filepos, filelen)
+    decoded from the raw table in one pass. It's a read-only sequence
+    of PackFile, but each PackFile is created when it's asked for: every
+    access returns a new object. in and index() compare entries by
+    name, filepos and filelen rather than identity so they still work.
+    """
+
     def __init__(self, raw):
-        self.name = _pythonifyString(raw[:56])
-        self.filepos, = struct.unpack("<I", raw[56:60])
-        self.filelen, = struct.unpack("<I", raw[60:64])
+        # view the table as uint32s; filepos/filelen are the last two of
+        # every 16, so both columns come out with a single strided copy
+        ints = memoryview(raw).cast("I")
+        self.filepos = array.array("I", ints[14::16])
+        self.filelen = array.array("I", ints[15::16])
+        if sys.byteorder != "little":
+            self.filepos.byteswap()
+            self.filelen.byteswap()
+
+        self.names = [archive.cString(raw[idx:idx + 56]).decode() for idx in range(0, len(raw), PackFile.DISK_SIZE)]
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return list(map(PackFile.newFromValues, self.names[idx], self.filepos[idx], self.filelen[idx]))
+        return PackFile.newFromValues(self.names[idx], self.filepos[idx], self.filelen[idx])
 
+    def __iter__(self):
+        return map(PackFile.newFromValues, self.names, self.filepos, self.filelen)
 
-class Pack(object):
+    def __contains__(self, f):
+        try:
+            self.index(f)
+        except ValueError:
+            return False
+        return True
+
+    def index(self, f, start=0, stop=None):
+        if stop is None:
+            stop = len(self.names)
+        name = getattr(f, "name", None)
+        while True:
+            # raises ValueError once there are no more of that name
+            start = self.names.index(name, start, stop)
+            if self.filepos[start] == f.filepos and self.filelen[start] == f.filelen:
+                return start
+            start += 1
+
+
+class _PackDir(object):
+    """
+    One node of the directory tree built over a pak's (flat) file names.
+    subdirs maps a path component to its child node, files maps a
+    component to the index of the entry in Pack.files.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.subdirs = {}
+        self.files = {}
+
+    @classmethod
+    def newFromNames(cls, names):
+        root = cls("")
+        for idx, name in enumerate(names):
+            node = root
+            parts = name.split("/")
+            for part in parts[:-1]:
+                if not part:
+                    continue
+                sub = node.subdirs.get(part)
+                if sub is None:
+                    sub = node.subdirs[part] = cls(node.join(part))
+                node = sub
+            node.files[parts[-1]] = idx
+        return root
+
+    def join(self, name):
+        if self.path:
+            return self.path + "/" + name
+        return name
+
+    def find(self, path):
+        node = self
+        for part in path.split("/"):
+            if part:
+                node = node.subdirs.get(part)
+                if node is None:
+                    return None
+        return node
+
+    def walk(self):
+        yield self
+        for sub in self.subdirs.values():
+            yield from sub.walk()
+
+    def glob(self, parts):
+        pat = parts[0]
+        rest = parts[1:]
+
+        if pat == "**":
+            # zero or more directory levels
+            if rest:
+                yield from self.glob(rest)
+            else:
+                for node in self.walk():
+                    yield from (node.join(n) for n in node.files)
+                return
+            for sub in self.subdirs.values():
+                yield from sub.glob(parts)
+            return
+
+        if not any(c in pat for c in "*?["):
+            # plain component; straight dict lookups
+            if rest:
+                sub = self.subdirs.get(pat)
+                if sub is not None:
+                    yield from sub.glob(rest)
+            elif pat in self.files:
+                yield self.join(pat)
+            return
+
+        if rest:
+            for name, sub in self.subdirs.items():
+                if fnmatch.fnmatchcase(name, pat):
+                    yield from sub.glob(rest)
+        else:
+            yield from (self.join(n) for n in self.files if fnmatch.fnmatchcase(n, pat))
+
+
+class Pack(archive.Archive):
     """
     Pak file starts off with a 4-byte identifier, then 2 little-endian
     ints telling the directory offset and length. The directory is
     composed of a bunch of entries, one for each file represented inside
     the pak file. Each directory entry is 64 bytes, telling the name of
     the data and where it is located within the file.
+
+    With mmap=True readFile returns zero-copy memoryview slices of the
+    mapped archive. Otherwise reads are positional, so one opened Pack
+    can be shared across a pool of reader threads. (Both come from
+    archive.Archive.)
+
+    A directory tree over the entry names is built on open, so listdir,
+    walk and glob only visit the part of the archive they return.
+
+    With compact=True the directory is decoded in bulk into flat arrays
+    and files is a lazy sequence creating PackFile objects on access,
+    which makes opening paks with 100k+ entries much faster and smaller.
+    The directory tree is then only built the first time it's needed.
     """
 
-    def __init__(self, path=""):
-        self.files = []
+    MAGICS = (b"PACK",)
+    KIND = "pak"
+    ENTRY_CLASS = PackFile
+    ENTRY_KIND = "pakfile entry"
 
-        self._handle = None
-        self._filename_to_file = {}
+    def __init__(self, path="", mmap=False, compact=False, cache_bytes=0):
+        self._tree = _PackDir("")
+        self._compact = compact
+
+        super(Pack, self).__init__(path, mmap=mmap, cache_bytes=cache_bytes)
+
+    @property
+    def files(self):
+        return self._entries
+
+    @property
+    def _filename_to_file(self):
+        return archive.NameMap(self._entries, self._name_to_idx)
+
+    def _parseHeader(self, header):
+        return struct.unpack("<II", header[4:12])
+
+    def _decodeDirectory(self, raw):
+        raw = raw[:len(raw) - len(raw) % PackFile.DISK_SIZE]
 
-        if path:
-            self.open(path)
+        if self._compact:
+            files = _CompactDirectory(raw)
+            return (files, files.names, { n: idx for idx, n in enumerate(files.names) })
+
+        files = [PackFile.newFromValues(archive.cString(name).decode(), filepos, filelen) for name, filepos, filelen in _packfile_struct.iter_unpack(raw)]
+        names = [f.name for f in files]
+        return (files, names, { n: idx for idx, n in enumerate(names) })
+
+    def _entrySpan(self, f):
+        return (f.filepos, f.filelen)
 
     def open(self, path):
-        handle = open(path, "rb")
+        super(Pack, self).open(path)
+
+        if self._compact:
+            self._tree = None
+        else:
+            self._tree = _PackDir.newFromNames(self._names)
+
+    def close(self):
+        super(Pack, self).close()
+        self._tree = _PackDir("")
+
+    def readFile(self, f):
+        return self._readEntry(f)
 
-        if handle.read(4) != b"PACK":
-            raise Exception("\"{}\" is not a valid pak file".format(path))
+    async def areadFile(self, f):
+        return await self._areadEntry(f)
 
-        dirofs, = struct.unpack("<I", handle.read(4))
-        dirlen, = struct.unpack("<I", handle.read(4))
+    def aiterFile(self, f, chunk_size=archive.COPY_CHUNK_SIZE):
+        return self._aiterEntry(f, chunk_size)
 
-        handle.seek(dirofs)
-        raw = handle.read(dirlen)
-        files = [PackFile(raw[idx * PackFile.DISK_SIZE:(idx + 1) * PackFile.DISK_SIZE]) for idx in range(dirlen // PackFile.DISK_SIZE)]
+    def hasFile(self, path):
+        return path in self._name_to_idx
+
+    def _getTree(self):
+        if self._tree is None:
+            # only compact directories defer building the tree
+            self._tree = _PackDir.newFromNames(self._names)
+        return self._tree
+
+    def listdir(self, prefix=""):
+        """
+        Names of the subdirectories and files directly inside the given
+        directory, like os.listdir.
+        """
+
+        node = self._getTree().find(prefix)
+        if node is None:
+            raise Exception("no directory \"{}\" in pak".format(prefix))
+        return list(node.subdirs.keys()) + list(node.files.keys())
+
+    def walk(self, prefix=""):
+        """
+        Yield (dirpath, dirnames, filenames) tuples for each directory
+        at or below prefix, like os.walk.
+        """
+
+        node = self._getTree().find(prefix)
+        if node is None:
+            return
+        for n in node.walk():
+            yield (n.path, list(n.subdirs.keys()), list(n.files.keys()))
+
+    def glob(self, pattern):
+        """
+        Full names of the files matching a glob pattern such as
+        "progs/*.mdl". Wildcards don't cross a "/", except for a "**"
+        component which matches any number of directories.
+        """
+
+        return list(self._getTree().glob(pattern.split("/")))
 
-        self.close()
-        self.files = files
-        self._handle = handle
+    def verify(self, jobs=4, window=8 * 1024 * 1024):
+        """
+        Sanity check the directory and hash the archive. Returns a
+        manifest dict, ready to be dumped as JSON:
+
+        { "size": archive_size,
+          "window": window,
+          "window_sha256": archive_digest,
+          "files": [ { "name", "filepos", "filelen", "sha256" }, ... ],
+          "errors": [ "description", ... ] }
+
+        The archive digest is not a plain sha256 of the file: the file
+        is cut into window sized pieces, and it's the sha256 of their
+        concatenated (binary) sha256 digests. That way the pieces can
+        be hashed in parallel too.
+
+        Entries running past the end of the file, into the header or
+        into the directory, or partially overlapping another entry are
+        reported as errors (and get no digest). Entries sharing exactly
+        the same data are fine and are only hashed once. Empty entries
+        can only go wrong by pointing past the end of the file.
+
+        Hashing is spread over a pool of jobs threads, each reading in
+        big sequential windows; hashlib releases the GIL on large
+        buffers, so this scales with cores as well as with disk.
+        """
+
+        size = self._fileSize()
+        files = list(self.files)
+        errors = []
+
+        dirrange = (self._tableofs, self._tableofs + self._tablelen)
+        if dirrange[1] > size:
+            errors.append("directory runs past end of file")
+
+        # check unique data ranges in file order
+        good = set()
+        prev_end = 0
+        for pos, end in sorted(set((f.filepos, f.filepos + f.filelen) for f in files)):
+            if end > size:
+                errors.append("data at {} ({} bytes) runs past end of file".format(pos, end - pos))
+            elif pos < 12 and end > pos:
+                errors.append("data at {} overlaps the header".format(pos))
+            elif pos < dirrange[1] and end > dirrange[0] and end > pos:
+                errors.append("data at {} ({} bytes) overlaps the directory".format(pos, end - pos))
+            elif pos < prev_end and end > pos:
+                errors.append("data at {} ({} bytes) overlaps other data".format(pos, end - pos))
+            else:
+                good.add((pos, end))
+                prev_end = max(prev_end, end)
+
+        def _hashRange(offset, length):
+            h = hashlib.sha256()
+            end = offset + length
+            while offset < end:
+                n = min(window, end - offset)
+                h.update(self._readAt(offset, n))
+                offset += n
+            return h
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as ex:
+            pieces = ex.map(lambda ofs: _hashRange(ofs, min(window, size - ofs)).digest(), range(0, size, window))
+            # biggest first, so one huge entry doesn't finish last alone
+            ranges = sorted(good, key=lambda r: r[0] - r[1])
+            digests = dict(zip(ranges, ex.map(lambda r: _hashRange(r[0], r[1] - r[0]).hexdigest(), ranges)))
+
+            manifest = { "size": size,
+                         "window": window,
+                         "window_sha256": hashlib.sha256(b"".join(pieces)).hexdigest(),
+                         "files": [],
+                         "errors": errors }
+
+        for f in files:
+            manifest["files"].append({ "name": f.name,
+                                       "filepos": f.filepos,
+                                       "filelen": f.filelen,
+                                       "sha256": digests.get((f.filepos, f.filepos + f.filelen)) })
+
+        return manifest
+
+
+class _LooseFile(object):
+    """
+    Directory entry for a file sitting loose on disk, standing in for a
+    PackFile.
+    """
+
+    def __init__(self, name, filelen):
+        self.name = name
+        self.filepos = 0
+        self.filelen = filelen
+
+
+class _LooseDir(object):
+    """
+    A directory of loose files, exposing just enough of the Pack
+    interface to be mounted in a PackFileSystem.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.files = []
+        self._filename_to_file = {}
+
+        for dirpath, dirnames, filenames in os.walk(root):
+            for fn in filenames:
+                path = os.path.join(dirpath, fn)
+                name = "/".join(os.path.relpath(path, root).split(os.path.sep))
+                self.files.append(_LooseFile(name, os.path.getsize(path)))
         self._filename_to_file = { f.name: f for f in self.files }
 
     def close(self):
-        if self._handle:
-            self.files = []
-            self._handle.close()
-            self._handle = None
-            self._filename_to_file = {}
+        self.files = []
+        self._filename_to_file = {}
 
     def readFile(self, f):
-        if isinstance(f, int):
-            f = self.files[f]
-        elif isinstance(f, str):
+        if isinstance(f, str):
             f = self._filename_to_file[f]
-        elif isinstance(f, PackFile):
-            pass
+        with open(os.path.join(self.root, *f.name.split("/")), "rb") as fp:
+            return fp.read()
+
+    def hasFile(self, path):
+        return path in self._filename_to_file
+
+
+class PackFileSystem(object):
+    """
+    Quake-style search path over several paks (and loose directories).
+    Sources are mounted in order, a later mount overriding any file of
+    the same name in an earlier one, just like pak0..pakN.
+
+    A single merged { name: (archive, entry) } index answers every lookup
+    with one dict access. Mounting or unmounting a single source only
+    revisits the names that source contains.
+    """
+
+    def __init__(self, sources=()):
+        self.archives = []
+
+        self._index = {}
+        # ids of the archives mount opened from a path, which close closes
+        self._opened = set()
+
+        for src in sources:
+            self.mount(src)
+
+    def mount(self, src, index=None):
+        """
+        Add a source to the search path. src is a Pack, a path to a pak
+        file or a path to a directory. By default it goes on top, taking
+        precedence over everything already mounted; an index into the
+        archives list can be given to slot it in lower down.
+        Returns the mounted archive.
+
+        An archive opened here from a path is closed along with the
+        file system; a Pack handed in is left for the caller to close.
+        """
+
+        if isinstance(src, str):
+            if os.path.isdir(src):
+                src = _LooseDir(src)
+            else:
+                src = Pack(src)
+            self._opened.add(id(src))
+
+        if index is None:
+            index = len(self.archives)
+        self.archives.insert(index, src)
+
+        rank = { id(a): i for i, a in enumerate(self.archives) }
+        for name, entry in src._filename_to_file.items():
+            cur = self._index.get(name)
+            if cur is None or rank[id(cur[0])] < index:
+                self._index[name] = (src, entry)
+
+        return src
+
+    def unmount(self, src):
+        """
+        Remove a previously mounted archive. Names it was providing fall
+        back to the next archive down that has them. The archive itself
+        is not closed, even if mount opened it; that's up to the caller
+        from then on.
+        """
+
+        for idx, a in enumerate(self.archives):
+            if a is src:
+                del self.archives[idx]
+                break
         else:
-            raise Exception("invalid pakfile entry \"{}\"".format(f))
+            raise Exception("archive is not mounted")
+        self._opened.discard(id(src))
+
+        for name in src._filename_to_file.keys():
+            cur = self._index.get(name)
+            if cur is None or cur[0] is not src:
+                continue
+            for other in reversed(self.archives):
+                entry = other._filename_to_file.get(name)
+                if entry is not None:
+                    self._index[name] = (other, entry)
+                    break
+            else:
+                del self._index[name]
+
+    def close(self):
+        for a in self.archives:
+            if id(a) in self._opened:
+                a.close()
+        self.archives = []
+        self._index = {}
+        self._opened = set()
+
+    def lookup(self, path):
+        """
+        Get the (archive, entry) pair that currently provides the given
+        file.
+        """
 
-        self._handle.seek(f.filepos)
-        return self._handle.read(f.filelen)
+        try:
+            return self._index[path]
+        except KeyError:
+            raise Exception("file \"{}\" not found".format(path))
+
+    def readFile(self, path):
+        src, entry = self.lookup(path)
+        return src.readFile(entry)
 
     def hasFile(self, path):
-        return path in self._filename_to_file.keys()
+        return path in self._index
+
+    def names(self):
+        return self._index.keys()
+
+
+def extractFiles(pack, names, jobs=1):
+    """
+    Write the named entries out to files of the same (relative) path.
+    The whole directory tree is created first, then entries are read in
+    archive order and written out by a pool of jobs worker threads.
+    Yields each PackFile as it is written, also in archive order.
+    """
+
+    # a name given twice would have two workers writing the same file
+    entries = sorted((pack._filename_to_file[name] for name in dict.fromkeys(names)), key=lambda f: f.filepos)
+
+    for dirs in set(os.path.dirname(f.name) for f in entries):
+        if dirs:
+            os.makedirs(dirs, exist_ok=True)
+
+    def _extract(f):
+        dat = pack.readFile(f)
+        with open(f.name, "wb") as fp:
+            fp.write(dat)
+        return f
+
+    if jobs > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as ex:
+            yield from ex.map(_extract, entries)
+    else:
+        yield from map(_extract, entries)
 
 
 if __name__ == "__main__":
-    import os
-    import sys
+    import time
 
-    if len(sys.argv) == 1:
-        pass
-    elif len(sys.argv) == 2:
-        p = Pack(sys.argv[1])
+    import json
+
+    args = sys.argv[1:]
+    jobs = None
+    if "-j" in args:
+        idx = args.index("-j")
+        if args[idx + 1:idx + 2] and args[idx + 1].isdigit():
+            jobs = max(int(args[idx + 1]), 1)
+            del args[idx:idx + 2]
+        else:
+            args = []
+
+    if len(args) == 0 or (args[0] == "--hash" and len(args) != 2):
+        print("usage: {} [-j N] <pak> [name ... | *]".format(sys.argv[0]))
+        print("       {} [-j N] --hash <pak>".format(sys.argv[0]))
+        print("")
+        print("List the files in a pak, or extract the named ones (* for\nall of them). --hash prints a json manifest of the sha256\nof each file and reports directory errors. -j spreads the\nwork over N threads.")
+        sys.exit(0)
+
+    if args[0] == "--hash":
+        # print a verification/checksum manifest as json
+        manifest = Pack(args[1]).verify(jobs=4 if jobs is None else jobs)
+        print(json.dumps(manifest, indent=1))
+        if manifest["errors"]:
+            sys.exit(1)
+    elif len(args) == 1:
+        p = Pack(args[0])
         print("offset size name")
         for f in p.files:
             print("{} {} {}".format(f.filepos, f.filelen, f.name))
         print("{} files".format(len(p.files)))
     else:
-        p = Pack(sys.argv[1])
+        if jobs is None:
+            jobs = 1
+        p = Pack(args[0])
 
-        if len(sys.argv) >= 3:
-            if sys.argv[2] == "*":
-                names = (f.name for f in p.files)
-            else:
-                names = sys.argv[2:]
+        if args[1] == "*":
+            names = [f.name for f in p.files]
         else:
-            names = []
-
-        for name in names:
-            dirs = os.path.dirname(name)
-            if dirs and not os.path.isdir(dirs):
-                os.makedirs(dirs)
-            dat = p.readFile(name)
-            fp = open(name, "wb")
-            fp.write(dat)
-            fp.close()
-            print("wrote {} bytes to \"{}\"".format(len(dat), name))
+            names = args[1:]
+
+        start = time.time()
+        count = 0
+        total = 0
+        for f in extractFiles(p, names, jobs):
+            print("wrote {} bytes to \"{}\"".format(f.filelen, f.name))
+            count += 1
+            total += f.filelen
+        elapsed = max(time.time() - start, 1e-6)
+
+        print("{} files, {} bytes in {:.2f}s ({:.1f} MB/s, {} jobs)".format(count, total, elapsed, total / elapsed / (1024 * 1024), jobs))
@@ -0,0 +1,98 @@
+"""
+Expand 8-bit palette indices to RGB/RGBA in bulk.
+
+Each palette channel is turned into a 256-byte translation table, so
+expanding an image is one bytes.translate per channel plus strided slice
+assignments to interleave them, all done in C. NumPy is used instead
+when it's installed.
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class Palette(object):
+    """
+    A 256-color palette. raw is 768 bytes of RGB triplets (a shorter
+    palette is padded with black), or a list of 3-byte entries.
+    """
+
+    def __init__(self, raw):
+        if not isinstance(raw, (bytes, bytearray, memoryview)):
+            raw = b"".join(bytes(c) for c in raw)
+        raw = bytes(raw[:768])
+        self.raw = raw + b"\x00" * (768 - len(raw))
+
+        # per-channel lookup tables for bytes.translate
+        self._planes = (self.raw[0::3], self.raw[1::3], self.raw[2::3])
+
+        if numpy is not None:
+            self._array = numpy.frombuffer(self.raw, dtype=numpy.uint8).reshape(256, 3)
+
+    def toRGB(self, indices):
+        """
+        Expand a byte string of palette indices to RGB bytes.
+        """
+
+        if numpy is not None:
+            return self._array[numpy.frombuffer(indices, dtype=numpy.uint8)].tobytes()
+
+        indices = bytes(indices)
+        out = bytearray(len(indices) * 3)
+        for ch, plane in enumerate(self._planes):
+            out[ch::3] = indices.translate(plane)
+        return bytes(out)
+
+    def toRGBA(self, indices, transparent_index=None, mask=None):
+        """
+        Expand palette indices to RGBA bytes. If mask (a byte string as
+        long as indices) is given, pixels with a 0 in it get alpha 0.
+        Otherwise pixels using transparent_index do. Everything else is
+        opaque.
+        """
+
+        if mask is not None:
+            alpha = bytes(mask).translate(b"\x00" + b"\xff" * 255)
+        elif transparent_index is not None:
+            table = bytearray(b"\xff" * 256)
+            table[transparent_index] = 0
+            alpha = bytes(indices).translate(table)
+        else:
+            alpha = None
+
+        if numpy is not None:
+            idx = numpy.frombuffer(indices, dtype=numpy.uint8)
+            out = numpy.empty((len(idx), 4), dtype=numpy.uint8)
+            out[:, :3] = self._array[idx]
+            out[:, 3] = 0xff if alpha is None else numpy.frombuffer(alpha, dtype=numpy.uint8)
+            return out.tobytes()
+
+        indices = bytes(indices)
+        out = bytearray(b"\xff" * (len(indices) * 4))
+        for ch, plane in enumerate(self._planes):
+            out[ch::4] = indices.translate(plane)
+        if alpha is not None:
+            out[3::4] = alpha
+        return bytes(out)
+
+
+def expandToRGB(indices, palette):
+    """
+    Shortcut for Palette(palette).toRGB(indices).
+    """
+
+    if not isinstance(palette, Palette):
+        palette = Palette(palette)
+    return palette.toRGB(indices)
+
+
+def expandToRGBA(indices, palette, transparent_index=None, mask=None):
+    """
+    Shortcut for Palette(palette).toRGBA(...).
+    """
+
+    if not isinstance(palette, Palette):
+        palette = Palette(palette)
+    return palette.toRGBA(indices, transparent_index, mask)
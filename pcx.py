@@ -29,7 +29,7 @@ class _PCXHeader(object):
 
     def __init__(self, raw=None):
         if raw is None:
-            raw = "\x00" * self.DISK_SIZE
+            raw = b"\x00" * self.DISK_SIZE
 
         idx = 0
         for obj, fmt in self.MEMBERS:
@@ -38,8 +38,8 @@ class _PCXHeader(object):
             idx += sz
             setattr(self, obj, struct.unpack(fmt, dat)[0])
 
-    def __repr__(self):
-        return "".join([struct.pack(fmt, getattr(self, obj)) for obj, fmt in self.MEMBERS])
+    def toBytes(self):
+        return b"".join([struct.pack(fmt, getattr(self, obj)) for obj, fmt in self.MEMBERS])
 
 
 def loadPCX(path):
@@ -69,56 +69,53 @@ def loadPCXFromRaw(raw):
     if width <= 0 or height <= 0:
         raise Exception("invalid image dimensions %dx%d" % (width, height))
 
-    pixels = ""
+    pixels = bytearray()
     idx = header.DISK_SIZE
-    for y in xrange(height):
-        x = 0
-        while x < header.bytes_per_line:
+    for y in range(height):
+        row = bytearray()
+        while len(row) < header.bytes_per_line:
             p = raw[idx]
             idx += 1
-            if (ord(p) & 0xc0) == 0xc0:
-                c = ord(p) & 0x3f
+            if (p & 0xc0) == 0xc0:
+                c = p & 0x3f
                 p = raw[idx]
                 idx += 1
             else:
                 c = 1
-            while c > 0:
-                if x < width:
-                    # bytes_per_line must always be even, although the
-                    # image width might be odd. So ignore extra bytes
-                    # that don't contribute to the image's pixels.
-                    pixels += p
-                x += 1
-                c -= 1
-
-    if raw[idx] != "\x0c":
+            row += bytes((p,)) * c
+        # bytes_per_line must always be even, although the image width
+        # might be odd. So ignore extra bytes that don't contribute to
+        # the image's pixels.
+        pixels += row[:width]
+
+    if raw[idx] != 0x0c:
         raise Exception("missing palette identifier byte")
 
     palette = raw[-768:]
 
-    return (width, height, palette, pixels)
+    return (width, height, palette, bytes(pixels))
 
 
 def writePCX(path, width, height, palette, pixels):
 
     def _encodeRow(row):
         idx = 0
-        ret = ""
+        ret = bytearray()
         while idx < len(row):
             c = 0
             p = row[idx]
             while idx < len(row) and row[idx] == p and c < 0x3f:
                 idx += 1
                 c += 1
-            if c > 1 or (ord(p) & 0xc0) == 0xc0:
-                ret += chr(0xc0 + c)
-            ret += p
+            if c > 1 or (p & 0xc0) == 0xc0:
+                ret.append(0xc0 + c)
+            ret.append(p)
 
         if len(row) & 1:
             # PCX spec says each row must have an even byte count
-            ret += "\x00"
+            ret.append(0)
 
-        return ret
+        return bytes(ret)
 
     if width * height != len(pixels):
         raise Exception("pixel count does not match given dimensions")
@@ -140,11 +137,24 @@ def writePCX(path, width, height, palette, pixels):
     header.bytes_per_line = (width + 1) & ~1
     header.pal_type = 1
 
-    rle = "".join([_encodeRow(pixels[y * width:(y + 1) * width]) for y in xrange(height)])
+    rle = b"".join([_encodeRow(pixels[y * width:(y + 1) * width]) for y in range(height)])
 
     fp = open(path, "wb")
-    fp.write(repr(header))
+    fp.write(header.toBytes())
     fp.write(rle)
-    fp.write("\x0c")
+    fp.write(b"\x0c")
     fp.write(palette)
     fp.close()
+
+
+if __name__ == "__main__":
+    import sys
+    import os
+    import png
+
+    for path in sys.argv[1:]:
+        width, height, palette, pixels = loadPCX(path)
+
+        base, ext = os.path.splitext(path)
+        outpath = os.path.extsep.join((base, "png"))
+        png.writeIndexedPNG(outpath, pixels, width, height, palette)
@@ -150,6 +150,58 @@ def buildPNG(pixels, width, height, is_rgba=False):
         return _buildTrueColor(pixels, width, height, True)
 
 
+def buildIndexedPNG(indices, width, height, palette, transparent_index=None):
+    """
+    Build a palettized PNG straight from 8-bit palette indices, without
+    going through RGB.
+
+    palette is a byte string of RGB triplets or a list of 3-byte
+    entries. A palette with fewer entries than the indices need is
+    padded with black. If transparent_index is given that palette entry
+    is written as fully transparent.
+    """
+
+    indices = bytes(indices)
+    if len(indices) != width * height:
+        raise Exception("pixel count does not match given dimensions")
+
+    if not isinstance(palette, (bytes, bytearray, memoryview)):
+        palette = b"".join(bytes(c) for c in palette)
+    palette = bytes(palette[:768])
+    palette = palette[:len(palette) - len(palette) % 3]
+
+    numcolors = len(palette) // 3
+    if indices:
+        numcolors = max(numcolors, max(indices) + 1)
+    if transparent_index is not None:
+        numcolors = max(numcolors, transparent_index + 1)
+    palette += b"\x00" * (numcolors * 3 - len(palette))
+
+    # filter type 0 on every row, as recommended for palettized images
+    filtered = b"".join((b"\x00" + indices[idx:idx + width] for idx in range(0, len(indices), width)))
+
+    ihdr_dat = struct.pack(">IIBBBBB", width, height, 8, 3, 0, 0, 0)
+
+    chunks = [_mkChunk("IHDR", ihdr_dat), _mkChunk("PLTE", palette)]
+    if transparent_index is not None:
+        # entries past the end of tRNS are opaque
+        chunks.append(_mkChunk("tRNS", b"\xff" * transparent_index + b"\x00"))
+    chunks.append(_mkChunk("IDAT", zlib.compress(filtered)))
+    chunks.append(_mkChunk("IEND", b""))
+
+    return _png_signature + b"".join(chunks)
+
+
+def writeIndexedPNG(path, indices, width, height, palette, transparent_index=None):
+    """
+    Build a palettized PNG from palette indices and write it out to a
+    file. See buildIndexedPNG.
+    """
+
+    with open(path, "wb") as fp:
+        fp.write(buildIndexedPNG(indices, width, height, palette, transparent_index=transparent_index))
+
+
 def writePNG(path, pixels, width, height, is_rgba=False):
     """
     Build a PNG image and write it out to a file.
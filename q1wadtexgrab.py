@@ -1,21 +1,31 @@
 #!/usr/bin/env python3
 
-import string
+import os
 import sys
+import json
+import struct
+import string
+import hashlib
+import concurrent.futures
 
 import wad2
+import pak
+import bsp
 import png
 import bytereader
 
 MIPLEVELS = 4
 
+# kept in the output directory; maps png name -> texture key
+CACHE_NAME = ".q1wadtexgrab-cache"
+
 
 def filtName(n):
     chars = string.ascii_letters + string.digits + "_"
     return "".join(filter(lambda c: c in chars, n))
 
 
-def parseTex(raw):
+def _parseTexHeader(raw):
     br = bytereader.ByteReader(raw)
     name = br.get("16s").decode()
     if "\x00" in name:
@@ -23,29 +33,306 @@ def parseTex(raw):
     w = br.getUInt()
     h = br.getUInt()
     offsets = [br.getUInt() for _ in range(MIPLEVELS)]
+    return (name, w, h, offsets)
+
+
+def parseTex(raw):
+    name, w, h, offsets = _parseTexHeader(raw)
 
     mip0_off = offsets[0]
     pix = raw[mip0_off:mip0_off + w * h]
     return (name, w, h, pix)
 
 
+def parseTexMips(raw):
+    """
+    Like parseTex, but returns every mip level:
+    (name, [(w, h, pix), ...]), each level half the size of the one
+    before it. Given a memoryview the pixels are slices of it.
+    """
+
+    name, w, h, offsets = _parseTexHeader(raw)
+
+    levels = []
+    for level, ofs in enumerate(offsets):
+        lw = max(w >> level, 1)
+        lh = max(h >> level, 1)
+        levels.append((lw, lh, raw[ofs:ofs + lw * lh]))
+    return (name, levels)
+
+
+def texKey(raw, pal, levels=1):
+    """
+    Content key of a miptex lump as extracted with a given palette
+    (and number of mip levels).
+    """
+
+    h = hashlib.sha256(pal)
+    if levels != 1:
+        h.update(b"%d levels" % levels)
+    h.update(raw)
+    return h.hexdigest()
+
+
+def _loadCache(path):
+    try:
+        with open(path, "rt") as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return {}
+
+
+def _saveCache(path, cache):
+    tmppath = path + ".tmp"
+    with open(tmppath, "wt") as fp:
+        json.dump(cache, fp, indent=0, sort_keys=True)
+    os.replace(tmppath, path)
+
+
+def _defaultPalette():
+    with open("PALETTE", "rb") as fp:
+        return fp.read()[:768]
+
+
+def _hasPixels(raw):
+    # bsps can leave the pixels out and refer to the texture in a wad
+    return raw is not None and len(raw) > 40
+
+
+class _WadSource(object):
+    """
+    The miptex lumps of a wad2. Texture refs are lump numbers.
+    """
+
+    def __init__(self, path):
+        self.wad = wad2.Wad2(path)
+
+    def palette(self):
+        if "PALETTE" in self.wad.lump_names:
+            return self.wad.readLump("PALETTE")[:768]
+        return _defaultPalette()
+
+    def textures(self):
+        for lumpnum, l in enumerate(self.wad.lumps):
+            if l.type == wad2.TYP_MIPTEX:
+                yield (lumpnum, self.wad.readLump(lumpnum))
+
+    def readTexture(self, ref):
+        return self.wad.readLump(ref)
+
+    def close(self):
+        self.wad.close()
+
+
+class _PakSource(object):
+    """
+    The textures embedded in all the bsps of a pak, read straight out
+    of the mmap'd pak. Texture refs are (file number, texture number).
+    """
+
+    def __init__(self, path):
+        self.pack = pak.Pack(path, mmap=True)
+
+    def palette(self):
+        if self.pack.hasFile("gfx/palette.lmp"):
+            return bytes(self.pack.readFile("gfx/palette.lmp")[:768])
+        return _defaultPalette()
+
+    def textures(self):
+        for filenum, f in enumerate(self.pack.files):
+            if f.name.lower().endswith(".bsp"):
+                try:
+                    lumps = bsp.textureLumps(self.pack.readFile(filenum))
+                except (ValueError, struct.error) as e:
+                    print("skipping \"{}\": {}".format(f.name, e))
+                    continue
+                for texnum, raw in enumerate(lumps):
+                    if _hasPixels(raw):
+                        yield ((filenum, texnum), raw)
+
+    def readTexture(self, ref):
+        filenum, texnum = ref
+        return bsp.textureLumps(self.pack.readFile(filenum))[texnum]
+
+    def close(self):
+        self.pack.close()
+
+
+class _BspSource(object):
+    """
+    The textures embedded in a bsp file. Texture refs are texture
+    numbers.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as fp:
+            self.raw = fp.read()
+
+    def palette(self):
+        return _defaultPalette()
+
+    def textures(self):
+        for texnum, raw in enumerate(bsp.textureLumps(self.raw)):
+            if _hasPixels(raw):
+                yield (texnum, raw)
+
+    def readTexture(self, ref):
+        return bsp.textureLumps(self.raw)[ref]
+
+    def close(self):
+        self.raw = None
+
+
+def _openSource(path):
+    with open(path, "rb") as fp:
+        magic = fp.read(4)
+
+    if magic == b"WAD2":
+        return _WadSource(path)
+    elif magic == b"PACK":
+        return _PakSource(path)
+    elif magic == struct.pack("<i", bsp.BSPVERSION):
+        return _BspSource(path)
+    raise ValueError("\"{}\" is not a wad2, pak or bsp file".format(path))
+
+
+# the source last read from by _writeTex in this process; jobs come in
+# source order so workers mostly keep reading from the same one
+_job_source = (None, None)
+
+
+def _writeTex(job):
+    global _job_source
+
+    path, ref, outpaths, pal = job
+    if _job_source[0] != path:
+        _closeJobSource()
+        _job_source = (path, _openSource(path))
+
+    tname, levels = parseTexMips(_job_source[1].readTexture(ref))
+    # "{" textures use color 255 for see-through pixels
+    transparent_index = 255 if tname.startswith("{") else None
+    for outpath, (tw, th, tpix) in zip(outpaths, levels):
+        png.writeIndexedPNG(outpath, tpix, tw, th, pal, transparent_index=transparent_index)
+    return outpaths[0]
+
+
+def _closeJobSource():
+    global _job_source
+
+    if _job_source[1] is not None:
+        _job_source[1].close()
+    _job_source = (None, None)
+
+
+def extractTextures(paths, outdir=".", jobs=1, force=False, mips=False):
+    """
+    Write out the textures of the given wad2 files, and of bsp files
+    (on their own or inside paks), as png files in outdir. Yields
+    (png_path, written) for every texture, written being False for ones
+    that were skipped. With mips set the smaller mip levels are written
+    too, as <name>_mip<level>.png.
+
+    Each texture is keyed by a hash of its lump and palette; the keys
+    of the pngs already in outdir are kept in a cache file there, and
+    textures whose pngs are up to date are skipped without decoding
+    them (unless force is set). When a texture name shows up more than
+    once the last one wins, as it always has.
+
+    With jobs > 1 the textures are decoded and written by a pool of
+    processes.
+    """
+
+    cachepath = os.path.join(outdir, CACHE_NAME)
+    cache = {} if force else _loadCache(cachepath)
+    numlevels = MIPLEVELS if mips else 1
+
+    # png name -> (key, job); dict order keeps the jobs in source order
+    todo = {}
+    for p in paths:
+        src = _openSource(p)
+        pal = None
+        for ref, raw in src.textures():
+            if pal is None:
+                pal = src.palette()
+
+            name = filtName(parseTex(raw)[0])
+            outname = "{}.png".format(name)
+            outpaths = [os.path.join(outdir, outname)]
+            outpaths.extend(os.path.join(outdir, "{}_mip{}.png".format(name, level)) for level in range(1, numlevels))
+            key = texKey(raw, pal, numlevels)
+
+            todo.pop(outname, None)
+            if cache.get(outname) == key and all(os.path.exists(o) for o in outpaths):
+                yield (outpaths[0], False)
+            else:
+                todo[outname] = (key, (p, ref, outpaths, pal))
+        raw = None
+        src.close()
+
+    names = list(todo.keys())
+    jobargs = [todo[n][1] for n in names]
+
+    try:
+        if jobs > 1 and len(jobargs) > 1:
+            with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+                chunksize = max(1, min(64, len(jobargs) // (jobs * 4)))
+                for outname, outpath in zip(names, executor.map(_writeTex, jobargs, chunksize=chunksize)):
+                    cache[outname] = todo[outname][0]
+                    yield (outpath, True)
+        else:
+            try:
+                for outname, outpath in zip(names, map(_writeTex, jobargs)):
+                    cache[outname] = todo[outname][0]
+                    yield (outpath, True)
+            finally:
+                _closeJobSource()
+    finally:
+        # remember whatever got written, even if something failed
+        _saveCache(cachepath, cache)
+
+
 if __name__ == "__main__":
-    for p in sys.argv[1:]:
-        w = wad2.Wad2(p)
+    import time
 
-        if "PALETTE" in w.lump_names:
-            pal = w.readLump("PALETTE")
+    args = sys.argv[1:]
+    jobs = 1
+    outdir = "."
+    if "-j" in args:
+        idx = args.index("-j")
+        if args[idx + 1:idx + 2] and args[idx + 1].isdigit():
+            jobs = max(int(args[idx + 1]), 1)
+            del args[idx:idx + 2]
+        else:
+            args = []
+    if "-o" in args:
+        idx = args.index("-o")
+        if args[idx + 1:idx + 2]:
+            outdir = args[idx + 1]
+            del args[idx:idx + 2]
         else:
-            with open("PALETTE", "rb") as fp:
-                pal = fp.read()
+            args = []
+    force = "-f" in args
+    mips = "-m" in args
+    args = [a for a in args if a not in ("-f", "-m")]
 
-        def _rgb(i):
-            return bytes((pal[i * 3 + 0], pal[i * 3 + 1], pal[i * 3 + 2]))
-        index2rgb = [_rgb(i) for i in range(256)]
+    if not args:
+        print("usage: {} [-j N] [-o outdir] [-f] [-m] <wad|pak|bsp> ...".format(sys.argv[0]))
+        print("")
+        print("Write out the textures of quake wad2 files, and the ones\nembedded in bsp files (also the bsps inside paks), as png\nfiles. -m writes all the mip levels. Textures that haven't\nchanged since the last run into the same output directory are\nskipped; -f extracts everything. -j spreads the work over N\nprocesses.")
+        sys.exit(0)
 
-        for l in w.lumps:
-            if l.type == wad2.TYP_MIPTEX:
-                tname, tw, th, tpix = parseTex(w.readLump(l))
-                outpath = "{}.png".format(filtName(tname))
-                rgbpix = b"".join((index2rgb[p] for p in tpix))
-                png.writePNG(outpath, rgbpix, tw, th, is_rgba=False)
+    os.makedirs(outdir, exist_ok=True)
+
+    start = time.time()
+    written = 0
+    skipped = 0
+    for outpath, was_written in extractTextures(args, outdir, jobs=jobs, force=force, mips=mips):
+        if was_written:
+            print("wrote \"{}\"".format(outpath))
+            written += 1
+        else:
+            skipped += 1
+    elapsed = time.time() - start
+
+    print("{} textures written, {} unchanged skipped in {:.2f}s ({} jobs)".format(written, skipped, elapsed, jobs))
@@ -4,38 +4,21 @@
 Utility to load/save DOOM engine wad files.
 """
 
+import sys
+import array
 import struct
 
-
-def iterChopBytes(b, chunk_len, count=None, start_offset=0):
-    """
-    Run through a string of bytes, yielding consecutive chunks out of
-    it. A starting byte offset can be given.
-    Note the last chunk could be less than chunk_len if the total length
-    isn't a multiple of chunk_len.
-    """
-
-    if count is not None:
-        idx = start_offset
-        while count > 0:
-            yield b[idx: idx + chunk_len]
-            idx += chunk_len
-            count -= 1
-    else:
-        idx = start_offset
-        while idx < len(b):
-            yield b[idx: idx + chunk_len]
-            idx += chunk_len
+import archive
+from archive import iterChopBytes
 
 
 def wadBytesToString(raw):
     """
     Convert a byte sequence read from a wad file to a python string.
+    raw can be any buffer, eg. a memoryview from an mmap'd wad.
     """
 
-    if b"\x00" in raw:
-        raw = raw[:raw.index(b"\x00")]
-    return raw.decode().upper()
+    return bytes(raw).split(b"\x00", 1)[0].decode().upper()
 
 
 def stringToWadBytes(s, maxlen=8):
@@ -49,46 +32,151 @@ def stringToWadBytes(s, maxlen=8):
 
 def writeWad(path, lumps):
     """
-    Write lumps out to a wad. The lumps array should be tuples in
-    (name, data) form.
+    Write lumps out to a wad. lumps can be any iterable (a generator is
+    fine) of (name, data) tuples, where data is anything
+    archive.writeData takes: bytes, a file path, a file object, a
+    callable producing the data, or an EntryRef to copy a lump straight
+    out of another open wad, eg:
+
+    writeWad(path, ((l.name, src.entryRef(l)) for l in src.lumps))
+
+    Each lump is streamed to disk once as it comes up; only the
+    directory is kept in memory.
     """
 
+    entries = []
+
     with open(path, "wb") as fp:
         # dummy header, will get overwritten later
         fp.write(b"\x00" * 12)
 
         # lump data
-        offs = []
         for lumpname, lumpdata in lumps:
-            offs.append(fp.tell())
-            fp.write(lumpdata)
+            if len(lumpname) > 8:
+                raise ValueError("lump name too long: \"{}\"".format(lumpname))
+            offset = fp.tell()
+            size = archive.writeData(fp, lumpdata)
+            entries.extend((offset, size, stringToWadBytes(lumpname)))
 
         # entry table
         infotableofs = fp.tell()
-        for offset, (lumpname, lumpdata) in zip(offs, lumps):
-            fp.write(struct.pack("<i", offset))
-            fp.write(struct.pack("<i", len(lumpdata)))
-            fp.write(stringToWadBytes(lumpname))
+        numlumps = len(entries) // 3
+        fp.write(struct.pack("<" + "ii8s" * numlumps, *entries))
 
         # header
         fp.seek(0)
         fp.write(b"PWAD")
-        fp.write(struct.pack("<i", len(lumps)))
+        fp.write(struct.pack("<i", numlumps))
         fp.write(struct.pack("<i", infotableofs))
 
 
+_wadlump_struct = struct.Struct("<ii8s")
+
+# lumps making up a (non-UDMF) map, following its header lump
+MAP_LUMPS = ("THINGS", "LINEDEFS", "SIDEDEFS", "VERTEXES", "SEGS",
+             "SSECTORS", "NODES", "SECTORS", "REJECT", "BLOCKMAP",
+             "BEHAVIOR", "SCRIPTS")
+
+
+# on-disk layouts of the binary map lumps; (field, struct format) in
+# record order. "8s" fields are texture/flat names.
+MAP_LUMP_FIELDS = {
+    "THINGS":   [("x", "h"), ("y", "h"), ("angle", "h"), ("type", "h"), ("options", "h")],
+    "LINEDEFS": [("v1", "H"), ("v2", "H"), ("flags", "H"), ("special", "H"), ("tag", "H"),
+                 ("sidenum_front", "H"), ("sidenum_back", "H")],
+    "SIDEDEFS": [("xoffset", "h"), ("yoffset", "h"), ("toptexture", "8s"),
+                 ("bottomtexture", "8s"), ("midtexture", "8s"), ("sector", "H")],
+    "VERTEXES": [("x", "h"), ("y", "h")],
+    "SEGS":     [("v1", "H"), ("v2", "H"), ("angle", "h"), ("linedef", "H"), ("side", "h"), ("offset", "h")],
+    "SSECTORS": [("numsegs", "H"), ("firstseg", "H")],
+    "NODES":    [("x", "h"), ("y", "h"), ("dx", "h"), ("dy", "h"),
+                 ("right_top", "h"), ("right_bottom", "h"), ("right_left", "h"), ("right_right", "h"),
+                 ("left_top", "h"), ("left_bottom", "h"), ("left_left", "h"), ("left_right", "h"),
+                 ("right_child", "H"), ("left_child", "H")],
+    "SECTORS":  [("floorheight", "h"), ("ceilingheight", "h"), ("floorpic", "8s"),
+                 ("ceilingpic", "8s"), ("lightlevel", "h"), ("special", "h"), ("tag", "h")],
+}
+
+# hexen format maps (those with a BEHAVIOR lump) only differ in these
+HEXEN_MAP_LUMP_FIELDS = dict(MAP_LUMP_FIELDS)
+HEXEN_MAP_LUMP_FIELDS.update({
+    "THINGS":   [("tid", "h"), ("x", "h"), ("y", "h"), ("height", "h"), ("angle", "h"),
+                 ("type", "h"), ("options", "h"), ("special", "B"),
+                 ("arg0", "B"), ("arg1", "B"), ("arg2", "B"), ("arg3", "B"), ("arg4", "B")],
+    "LINEDEFS": [("v1", "H"), ("v2", "H"), ("flags", "H"), ("special", "B"),
+                 ("arg0", "B"), ("arg1", "B"), ("arg2", "B"), ("arg3", "B"), ("arg4", "B"),
+                 ("sidenum_front", "H"), ("sidenum_back", "H")],
+})
+
+
+def decodeMapLump(lumpname, raw, hexen=False):
+    """
+    Decode a binary map lump (THINGS, LINEDEFS, VERTEXES, ...) into
+    columns: { field: array.array } with one item per record, eg.
+    cols["x"][i] is the x of vertex i. Each numeric column comes out of
+    a single strided copy over the raw lump, so no per-record objects
+    are made. Name fields (textures, flats) come out as a list of str
+    in which equal names share the same object.
+    """
+
+    fields = (HEXEN_MAP_LUMP_FIELDS if hexen else MAP_LUMP_FIELDS)[lumpname]
+    recsize = sum(struct.calcsize(fmt) for name, fmt in fields)
+
+    raw = memoryview(raw).cast("B")
+    raw = raw[:len(raw) - len(raw) % recsize]
+    words = raw.cast("H")
+
+    cols = {}
+    offs = 0
+    for name, fmt in fields:
+        sz = struct.calcsize(fmt)
+        if fmt == "8s":
+            names = {}
+            col = []
+            for idx in range(offs, len(raw), recsize):
+                n = bytes(raw[idx:idx + 8])
+                s = names.get(n)
+                if s is None:
+                    s = names[n] = wadBytesToString(n)
+                col.append(s)
+        elif sz == 1:
+            col = array.array(fmt, raw[offs::recsize].tobytes())
+        else:
+            # every 16-bit field sits at an even offset in an even-sized
+            # record, so it's a strided slice of the lump as 16-bit words
+            col = array.array(fmt, words[offs // 2::recsize // 2].tobytes())
+            if sys.byteorder != "little":
+                col.byteswap()
+        cols[name] = col
+        offs += sz
+
+    return cols
+
+
+def _namespaceKey(prefix):
+    """
+    SS_START/FF_START/PP_START are the pwad spellings of S_, F_ and P_.
+    """
+
+    if len(prefix) == 2 and prefix[0] == prefix[1]:
+        return prefix[0]
+    return prefix
+
+
 class WadLump(object):
     """
     On disk, each entry is 16 bytes. 8 for the name, 4 for the filepos,
     4 for the size.
     """
 
+    __slots__ = ("filepos", "size", "name")
+
     DISK_SIZE = 16
 
-    def __init__(self):
-        self.filepos = 0
-        self.size = 0
-        self.name = ""
+    def __init__(self, filepos=0, size=0, name=""):
+        self.filepos = filepos
+        self.size = size
+        self.name = name
 
     @classmethod
     def newFromBytes(cls, raw, offs):
@@ -99,73 +187,146 @@ class WadLump(object):
         return ret
 
 
-class Wad(object):
+class Wad(archive.LumpArchive):
     """
     Utility to read from wad files.
+
+    Maps (a header lump such as E1M1 or MAP01 followed by THINGS, or a
+    UDMF TEXTMAP..ENDMAP block) and X_START/X_END namespaces are indexed
+    on open, so mapLumps and namespace are plain dict lookups.
     """
 
-    def __init__(self, path=""):
-        self.lumps = []
-        self.lump_name_to_num = {}
-        self.lump_names = []
+    def __init__(self, path="", mmap=False, cache_bytes=0):
+        self._maps = {}
+        self._namespaces = {}
 
-        self._handle = None
+        super(Wad, self).__init__(path, mmap=mmap, cache_bytes=cache_bytes)
 
-        if path:
-            self.open(path)
+    MAGICS = (b"IWAD", b"PWAD")
+    KIND = "wad"
+    ENTRY_CLASS = WadLump
 
-    def open(self, path):
-        handle = open(path, "rb")
+    def _parseHeader(self, header):
+        numlumps, infotableofs = struct.unpack("<ii", header[4:12])
+        return (infotableofs, numlumps * WadLump.DISK_SIZE)
 
-        #FIXME: possible dangling file pointer on exceptions here... meh
+    def _decodeDirectory(self, raw):
+        raw = raw[:len(raw) - len(raw) % WadLump.DISK_SIZE]
 
-        if handle.read(4) not in (b"IWAD", b"PWAD"):
-            handle.close()
-            raise Exception("\"{}\" is not a valid wad file".format(path))
+        lumps = []
+        names = []
+        name_to_num = {}
+        # the same few names (THINGS, LINEDEFS, ...) come up over and
+        # over, so each distinct raw name is only decoded once
+        decoded = {}
 
-        numlumps, = struct.unpack("<i", handle.read(4))
-        infotableofs, = struct.unpack("<i", handle.read(4))
+        for num, (filepos, size, rawname) in enumerate(_wadlump_struct.iter_unpack(raw)):
+            name = decoded.get(rawname)
+            if name is None:
+                name = decoded[rawname] = wadBytesToString(rawname)
+            lumps.append(WadLump(filepos, size, name))
+            names.append(name)
+            name_to_num[name] = num
 
-        handle.seek(infotableofs)
-        raw = handle.read(numlumps * WadLump.DISK_SIZE)
-        lumps = [WadLump.newFromBytes(raw, idx * WadLump.DISK_SIZE) for idx in range(numlumps)]
+        return (lumps, names, name_to_num)
 
-        self.close()
-        self.lumps = lumps
-        self.lump_name_to_num = { l.name: idx for idx, l in enumerate(self.lumps) }
-        self.lump_names = [l.name for l in self.lumps]
-        self._handle = handle
+    def open(self, path):
+        super(Wad, self).open(path)
+        self._buildMarkerIndex()
 
     def close(self):
-        if self._handle:
-            self.lumps = []
-            self.lump_name_to_num = {}
-            self.lump_names = []
-            self._handle.close()
-            self._handle = None
-
-    def readLumpFromOffset(self, lumpname, offs):
-        while offs < len(self.lumps):
-            if self.lumps[offs].name == lumpname:
-                return self.readLump(self.lumps[offs])
-            offs += 1
-        raise Exception("unable to find lump \"{}\"".format(lumpname))
-
-    def readLump(self, l):
-        if isinstance(l, int):
-            l = self.lumps[l]
-        elif isinstance(l, str):
-            l = self.lumps[self.lump_name_to_num[l]]
-        elif isinstance(l, WadLump):
-            pass
-        else:
-            raise Exception("invalid lump \"{}\"".format(l))
-
-        return self.readBytes(l.filepos, l.size)
+        super(Wad, self).close()
+        self._maps = {}
+        self._namespaces = {}
+
+    def _buildMarkerIndex(self):
+        lumps = self.lumps
+        names = self.lump_names
+        maps = {}
+        namespaces = {}
+        open_ns = []
+
+        idx = 0
+        while idx < len(names):
+            name = names[idx]
+
+            nextname = names[idx + 1] if idx + 1 < len(names) else None
+            if nextname in ("THINGS", "TEXTMAP"):
+                # a map header; its lumps follow
+                maplumps = {}
+                idx += 1
+                if nextname == "TEXTMAP":
+                    while idx < len(names):
+                        maplumps[names[idx]] = lumps[idx]
+                        idx += 1
+                        if names[idx - 1] == "ENDMAP":
+                            break
+                else:
+                    while idx < len(names) and names[idx] in MAP_LUMPS:
+                        maplumps[names[idx]] = lumps[idx]
+                        idx += 1
+                maps[name] = maplumps
+                continue
+
+            if name.endswith("_START"):
+                open_ns.append(_namespaceKey(name[:-6]))
+            elif name.endswith("_END"):
+                key = _namespaceKey(name[:-4])
+                if key in open_ns:
+                    del open_ns[len(open_ns) - 1 - open_ns[::-1].index(key)]
+            else:
+                for key in open_ns:
+                    namespaces.setdefault(key, {})[name] = lumps[idx]
+            idx += 1
+
+        self._maps = maps
+        self._namespaces = namespaces
+
+    def mapNames(self):
+        return list(self._maps.keys())
+
+    def mapLumps(self, mapname):
+        """
+        Get the lumps of a map as { lumpname: WadLump }, eg:
+        w.readLump(w.mapLumps("MAP07")["THINGS"])
+        """
+
+        try:
+            return self._maps[mapname.upper()]
+        except KeyError:
+            raise Exception("unable to find map \"{}\"".format(mapname))
+
+    def namespace(self, ns):
+        """
+        Get the lumps between ns_START and ns_END markers (eg. "S" for
+        sprites, "F" for flats) as { lumpname: WadLump }, in wad order.
+        Several ranges of the same namespace are merged, later lumps
+        overriding earlier ones of the same name. Lumps in nested
+        ranges (F1_START inside F_START) are in both namespaces.
+        """
+
+        return self._namespaces.get(_namespaceKey(ns.upper()), {})
+
+    def isHexenMap(self, mapname):
+        return "BEHAVIOR" in self.mapLumps(mapname)
+
+    def readMap(self, mapname, lumpnames=None):
+        """
+        Decode the binary lumps of a map into columns (see
+        decodeMapLump), returning { lumpname: { field: column } }. The
+        doom or hexen layout is picked by whether the map has a BEHAVIOR
+        lump. By default every lump decodeMapLump knows is decoded.
+        """
+
+        maplumps = self.mapLumps(mapname)
+        hexen = "BEHAVIOR" in maplumps
+        if lumpnames is None:
+            lumpnames = [n for n in maplumps if n in MAP_LUMP_FIELDS]
+
+        return { n: decodeMapLump(n, self.readLump(maplumps[n]), hexen) for n in lumpnames }
 
     def readBytes(self, offset, count):
-        self._handle.seek(offset)
-        return self._handle.read(count)
+        return self._readAt(offset, count)
 
 
 if __name__ == "__main__":
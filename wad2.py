@@ -4,8 +4,12 @@
 Utility to load/save Quake 1 engine wad files.
 """
 
+import os
 import struct
 
+import archive
+from archive import iterChopBytes
+
 TYP_PALETTE = 64 # @
 TYP_QTEX    = 65 # A
 TYP_QPIC    = 66 # B
@@ -13,35 +17,13 @@ TYP_SOUND   = 67 # C
 TYP_MIPTEX  = 68 # D
 
 
-def iterChopBytes(b, chunk_len, count=None, start_offset=0):
-    """
-    Run through a string of bytes, yielding consecutive chunks out of
-    it. A starting byte offset can be given.
-    Note the last chunk could be less than chunk_len if the total length
-    isn't a multiple of chunk_len.
-    """
-
-    if count is not None:
-        idx = start_offset
-        while count > 0:
-            yield b[idx: idx + chunk_len]
-            idx += chunk_len
-            count -= 1
-    else:
-        idx = start_offset
-        while idx < len(b):
-            yield b[idx: idx + chunk_len]
-            idx += chunk_len
-
-
 def wadBytesToString(raw):
     """
     Convert a byte sequence read from a wad file to a python string.
+    raw can be any buffer, eg. a memoryview from an mmap'd wad.
     """
 
-    if b"\x00" in raw:
-        raw = raw[:raw.index(b"\x00")]
-    return raw.decode().upper()
+    return bytes(raw).split(b"\x00", 1)[0].decode().upper()
 
 
 def stringToWadBytes(s, maxlen=16):
@@ -53,35 +35,68 @@ def stringToWadBytes(s, maxlen=16):
     return raw + b"\x00" * (maxlen - len(raw))
 
 
-def writeWad(path, lumps):
+def writeWad(path, lumps, append=False, lumptype=TYP_MIPTEX):
     """
-    Write lumps out to a wad. The lumps array should be tuples in
-    (name, data) form.
+    Write lumps out to a wad. lumps can be any iterable (a generator is
+    fine) of (name, data) or (name, data, type) tuples; lumptype is used
+    for the former. data is anything archive.writeData takes: bytes, a
+    file path, a file object, a callable producing the data, or an
+    EntryRef to copy a lump straight out of another open wad.
+
+    Each lump is streamed to disk once as it comes up and the directory
+    is written in a single go at the end.
+
+    With append, the lumps are added to the end of an existing wad
+    instead (which is created if missing). Its data is left alone; only
+    the directory and header get rewritten.
     """
 
-    raise NotImplementedError()
-    #with open(path, "wb") as fp:
-    #    # dummy header, will get overwritten later
-    #    fp.write(b"\x00" * 12)
+    entries = []
+
+    if append and os.path.exists(path):
+        w = Wad2(path)
+        for l in w.lumps:
+            entries.extend((l.filepos, l.disksize, l.size, l.type, l.compression, l.pad1, l.pad2, stringToWadBytes(l.name)))
+        w.close()
+
+        fp = open(path, "r+b")
+        # new data goes after the old directory, so the wad stays
+        # valid until the new header is written
+        fp.seek(0, os.SEEK_END)
+    else:
+        fp = open(path, "wb")
+        # dummy header, will get overwritten later
+        fp.write(b"\x00" * 12)
+
+    with fp:
+        # lump data
+        for lump in lumps:
+            if len(lump) == 3:
+                lumpname, lumpdata, type_ = lump
+            else:
+                lumpname, lumpdata = lump
+                type_ = lumptype
+            if len(lumpname) > 16:
+                raise ValueError("lump name too long: \"{}\"".format(lumpname))
+
+            offset = fp.tell()
+            size = archive.writeData(fp, lumpdata)
+            entries.extend((offset, size, size, type_, 0, 0, 0, stringToWadBytes(lumpname)))
 
-    #    # lump data
-    #    offs = []
-    #    for lumpname, lumpdata in lumps:
-    #        offs.append(fp.tell())
-    #        fp.write(lumpdata)
+        # entry table
+        infotableofs = fp.tell()
+        numlumps = len(entries) // 8
+        fp.write(struct.pack("<" + "iiiBBBB16s" * numlumps, *entries))
+        fp.truncate()
 
-    #    # entry table
-    #    infotableofs = fp.tell()
-    #    for offset, (lumpname, lumpdata) in zip(offs, lumps):
-    #        fp.write(struct.pack("<i", offset))
-    #        fp.write(struct.pack("<i", len(lumpdata)))
-    #        fp.write(stringToWadBytes(lumpname))
+        # header
+        fp.seek(0)
+        fp.write(b"WAD2")
+        fp.write(struct.pack("<i", numlumps))
+        fp.write(struct.pack("<i", infotableofs))
 
-    #    # header
-    #    fp.seek(0)
-    #    fp.write(b"PWAD")
-    #    fp.write(struct.pack("<i", len(lumps)))
-    #    fp.write(struct.pack("<i", infotableofs))
+
+_wadlump_struct = struct.Struct("<iiiBBBB16s")
 
 
 class WadLump(object):
@@ -90,17 +105,19 @@ class WadLump(object):
     4 for the size.
     """
 
+    __slots__ = ("filepos", "disksize", "size", "type", "compression", "pad1", "pad2", "name")
+
     DISK_SIZE = 32
 
-    def __init__(self):
-        self.filepos = 0
-        self.disksize = 0 # unused
-        self.size = 0
-        self.type = 0
-        self.compression = 0 # unused
-        self.pad1 = 0 # unused
-        self.pad2 = 0 # unused
-        self.name = ""
+    def __init__(self, filepos=0, disksize=0, size=0, type_=0, compression=0, pad1=0, pad2=0, name=""):
+        self.filepos = filepos
+        self.disksize = disksize # unused
+        self.size = size
+        self.type = type_
+        self.compression = compression # unused
+        self.pad1 = pad1 # unused
+        self.pad2 = pad2 # unused
+        self.name = name
 
     @classmethod
     def newFromBytes(cls, raw, offs):
@@ -116,73 +133,36 @@ class WadLump(object):
         return ret
 
 
-class Wad2(object):
+class Wad2(archive.LumpArchive):
     """
     Utility to read from wad files.
     """
 
-    def __init__(self, path=""):
-        self.lumps = []
-        self.lump_name_to_num = {}
-        self.lump_names = []
-
-        self._handle = None
-
-        if path:
-            self.open(path)
-
-    def open(self, path):
-        handle = open(path, "rb")
-
-        #FIXME: possible dangling file pointer on exceptions here... meh
-
-        if handle.read(4) != b"WAD2":
-            handle.close()
-            raise Exception("\"{}\" is not a valid wad2 file".format(path))
-
-        numlumps, = struct.unpack("<i", handle.read(4))
-        infotableofs, = struct.unpack("<i", handle.read(4))
-
-        handle.seek(infotableofs)
-        raw = handle.read(numlumps * WadLump.DISK_SIZE)
-        lumps = [WadLump.newFromBytes(raw, idx * WadLump.DISK_SIZE) for idx in range(numlumps)]
-
-        self.close()
-        self.lumps = lumps
-        self.lump_name_to_num = { l.name: idx for idx, l in enumerate(self.lumps) }
-        self.lump_names = [l.name for l in self.lumps]
-        self._handle = handle
-
-    def close(self):
-        if self._handle:
-            self.lumps = []
-            self.lump_name_to_num = {}
-            self.lump_names = []
-            self._handle.close()
-            self._handle = None
-
-    def readLumpFromOffset(self, lumpname, offs):
-        while offs < len(self.lumps):
-            if self.lumps[offs].name == lumpname:
-                return self.readLump(self.lumps[offs])
-            offs += 1
-        raise Exception("unable to find lump \"{}\"".format(lumpname))
-
-    def readLump(self, l):
-        if isinstance(l, int):
-            l = self.lumps[l]
-        elif isinstance(l, str):
-            l = self.lumps[self.lump_name_to_num[l]]
-        elif isinstance(l, WadLump):
-            pass
-        else:
-            raise Exception("invalid lump \"{}\"".format(l))
-
-        return self.readBytes(l.filepos, l.size)
+    MAGICS = (b"WAD2",)
+    KIND = "wad2"
+    ENTRY_CLASS = WadLump
+
+    def _parseHeader(self, header):
+        numlumps, infotableofs = struct.unpack("<ii", header[4:12])
+        return (infotableofs, numlumps * WadLump.DISK_SIZE)
+
+    def _decodeDirectory(self, raw):
+        raw = raw[:len(raw) - len(raw) % WadLump.DISK_SIZE]
+
+        lumps = []
+        names = []
+        name_to_num = {}
+
+        for num, (filepos, disksize, size, type_, compression, pad1, pad2, rawname) in enumerate(_wadlump_struct.iter_unpack(raw)):
+            name = wadBytesToString(rawname)
+            lumps.append(WadLump(filepos, disksize, size, type_, compression, pad1, pad2, name))
+            names.append(name)
+            name_to_num[name] = num
+
+        return (lumps, names, name_to_num)
 
     def readBytes(self, offset, count):
-        self._handle.seek(offset)
-        return self._handle.read(count)
+        return self._readAt(offset, count)
 
 
 if __name__ == "__main__":